@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from environment.agent import ProposalBuffer
+from environment.env import Environment
+from environment.profiling import Profiler
+from sim import ENGINES
+from stats.results import write_results
+
+SIZES = [10, 100, 1000, 10000]
+STARTUP_MODULES = ["environment.env", "environment.vec_env", "sim", "sweep", "visualize"]
+CORE_MODULES = ["environment.env", "environment.vec_env"]
+STARTUP_TARGET_S = 0.05 # seconds to import the simulation core on top of NumPy
+LAZY_DEPENDENCIES = ["tqdm", "matplotlib", "pyarrow"] # only loaded on first use
+
+
+def peak_memory_mb():
+    # peak resident set size of this process. ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def time_startup(module, repeat=5):
+    """
+    Seconds a fresh interpreter takes to import module once NumPy is loaded, best of repeat,
+    and which of the lazily loaded dependencies the import pulled in anyway.
+    """
+    code = (f"import sys, time; import numpy; start = time.perf_counter(); import {module}; print(time.perf_counter() - start); "
+            f"print(','.join(name for name in {LAZY_DEPENDENCIES!r} if name in sys.modules))")
+    seconds = list()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.splitlines()
+        seconds.append(float(output[0]))
+    return min(seconds), [name for name in output[1].split(",") if name]
+
+
+def startup_benchmarks(modules=STARTUP_MODULES):
+    """
+    Time the import of every entry point. The simulation core meets its target if it imports in
+    STARTUP_TARGET_S on top of NumPy without loading any of LAZY_DEPENDENCIES.
+
+    :return: list of result rows
+    """
+    rows = list()
+    for module in modules:
+        seconds, loaded = time_startup(module)
+        row = {"module": module, "import_s": seconds, "lazy_dependencies_loaded": loaded}
+        if module in CORE_MODULES:
+            row["target_s"] = STARTUP_TARGET_S
+            row["meets_target"] = seconds <= STARTUP_TARGET_S and not loaded
+        print(f"{module:>20} imports in {seconds * 1000:6.1f} ms on top of NumPy"
+              + (f", loading {', '.join(loaded)}" if loaded else "")
+              + ("" if "meets_target" not in row else " (meets target)" if row["meets_target"] else " (MISSES TARGET)"))
+        rows.append(row)
+    return rows
+
+
+def time_episodes(env, episodes):
+    """
+    Run episodes with simulate under a Profiler.
+
+    :return: (seconds of the whole run, profiler summary)
+    """
+    profiler = Profiler().attach(env)
+    env.tracking = True # include stats tracking, as in the episodes whose results are saved
+    start = time.perf_counter()
+    env.simulate(n=episodes, progress=False)
+    elapsed = time.perf_counter() - start
+    profiler.detach(env)
+    return elapsed, profiler.summary()
+
+
+def time_q_updates(env, repeat):
+    """
+    Seconds per send Q-table update, updating every agent's table once per repeat.
+    """
+    rng = np.random.default_rng(0)
+    if isinstance(env, Environment):
+        agents = env.men + env.women
+        proposals = ProposalBuffer(len(agents))
+        updates = list()
+        for agent in agents:
+            i = proposals.add(agent, env.sides[agent.opp_side][rng.integers(agent.num_participants)], use_rose=bool(rng.integers(2)))
+            updates.append((agent, i, rng.normal(0, 50)))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for agent, i, reward in updates:
+                agent.update_send_q_table(proposals, i, reward)
+        return (time.perf_counter() - start) / (repeat * len(agents))
+
+    batches = list()
+    for population in [env.men, env.women]:
+        batches.append((population, np.arange(population.num_agents), rng.integers(population.num_participants, size=population.num_agents),
+                        rng.integers(2, size=population.num_agents), rng.normal(0, 50, population.num_agents)))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for population, agents, rows, cols, rewards in batches:
+            population.update_q_table(population.send_q_table, population.send_q_max, agents, rows, cols, rewards)
+    return (time.perf_counter() - start) / (repeat * (env.num_men + env.num_women))
+
+
+def time_assign_roses(env, repeat):
+    """
+    Seconds to assign roses to every agent of the market once.
+    """
+    rand = np.random.default_rng(0).random(env.num_men + env.num_women)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        env.rose_sampler.sample(rand)
+    return (time.perf_counter() - start) / repeat
+
+
+def bench(case):
+    """
+    Benchmark one engine at one market size. Runs in a fresh worker process so peak memory is its own.
+
+    :param case: dict with the engine, size (agents per side) and benchmark settings
+    """
+    row = dict(case)
+
+    start = time.perf_counter()
+    env = ENGINES[case["engine"]](num_men=case["size"], num_women=case["size"], max_proposals=case["max_proposals"],
+                                  cache_max_q=case["cache_max_q"], seed=0, q_dtype=case["q_dtype"])
+    row["setup_s"] = time.perf_counter() - start
+
+    if case["warmup"]:
+        env.simulate(n=case["warmup"], progress=False)
+    elapsed, profile = time_episodes(env, case["episodes"])
+    row["episodes_per_s"] = case["episodes"] / elapsed
+    row["proposals_per_s"] = profile["total_proposals"] / elapsed
+    for stage, timing in profile["stages"].items():
+        row[f"{stage}_s"] = timing["seconds"] / case["episodes"] # per episode
+
+    row["q_update_s"] = time_q_updates(env, repeat=3)
+    row["assign_roses_s"] = time_assign_roses(env, repeat=3)
+
+    with tempfile.TemporaryDirectory() as results_dir:
+        start = time.perf_counter()
+        write_results(results_dir, env.results_columns(), env.q_tables())
+        row["save_results_s"] = time.perf_counter() - start
+        row["peak_memory_mb"] = peak_memory_mb()
+
+        import visualize
+        start = time.perf_counter()
+        visualize.load_data(results_dir)
+        row["load_data_s"] = time.perf_counter() - start
+
+    return row
+
+
+def q_table_gb(size, q_dtype):
+    # memory of every dense Q-table of a market with size agents per side
+    return 2 * 2 * size * size * 2 * np.dtype(q_dtype).itemsize / 2**30
+
+
+def run_benchmarks(cases, max_q_gb=None):
+    """
+    Run every case in its own worker process, one after the other so they don't compete for the CPU.
+
+    :param max_q_gb: Skip cases whose Q-tables would need more memory than this many GiB
+    :return: list of result rows
+    """
+    rows = list()
+    for case in cases:
+        if max_q_gb is not None and q_table_gb(case["size"], case["q_dtype"]) > max_q_gb:
+            print(f"Skipping {case['engine']} at {case['size']} per side: its Q-tables need more than {max_q_gb} GiB")
+            rows.append({**case, "skipped": True})
+            continue
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            row = pool.submit(bench, case).result()
+        print(f"{row['engine']:>10} {row['size']:>6} per side: {row['episodes_per_s']:10.2f} episodes/s "
+              f"{row['proposals_per_s']:12.0f} proposals/s {row['peak_memory_mb']:9.1f} MiB peak")
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the simulation engines at several market sizes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help=f"Numbers of agents per side to benchmark. Default is {SIZES}.")
+    parser.add_argument("--engines", type=str, nargs="+", choices=list(ENGINES), default=list(ENGINES), help="Engines to benchmark. Default is all of them.")
+    parser.add_argument("--episodes", type=int, default=20, help="Number of timed episodes per benchmark. Default is 20.")
+    parser.add_argument("--warmup", type=int, default=2, help="Number of untimed episodes to run first. Default is 2.")
+    parser.add_argument("--max_proposals", type=int, default=3, help="Maximum number of proposals each agent can send. Default is 3.")
+    parser.add_argument("--cache_max_q", action="store_true", help="Raise flag to benchmark with running maxima of the Q-tables.")
+    parser.add_argument("--q_dtype", type=str, choices=["float64", "float32"], default="float64", help="Precision of the Q-tables. Default is float64.")
+    parser.add_argument("--max_q_gb", type=float, default=4, help="Skip market sizes whose Q-tables need more GiB of memory than this. Default is 4.")
+    parser.add_argument("--startup_only", action="store_true", help=f"Raise flag to only check the import time of the entry points against the target of {STARTUP_TARGET_S * 1000:.0f} ms for the simulation core.")
+    parser.add_argument("--out", type=str, default="benchmark.json", help="JSON file to write the results to. Default is 'benchmark.json'.")
+    args = parser.parse_args()
+
+    cases = [
+        {"engine": engine, "size": size, "max_proposals": args.max_proposals, "episodes": args.episodes, "warmup": args.warmup,
+         "cache_max_q": args.cache_max_q, "q_dtype": args.q_dtype}
+        for size in args.sizes for engine in args.engines
+    ]
+    startup = startup_benchmarks()
+    rows = list() if args.startup_only else run_benchmarks(cases, max_q_gb=args.max_q_gb)
+
+    with open(args.out, "w") as file:
+        json.dump({
+            "machine": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                        "processor": platform.processor(), "cpu_count": os.cpu_count()},
+            "startup": startup,
+            "results": rows,
+        }, file, indent=4)
@@ -0,0 +1,229 @@
+import argparse
+import csv
+import fnmatch
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from stats.analysis import load_columns, summarize_columns
+from stats.results import STATS_TABLE
+
+
+CATALOG_VERSION = 1
+AGENT_FILE = re.compile(r"^.+_\d+\.json$") # {agent_id}.json files of the legacy format
+
+
+def stats_files(results_dir):
+    """
+    Files holding the stats of a run: its stats table, or every per-agent JSON file of the legacy format.
+    Empty if results_dir is not a run.
+    """
+    file_names = os.listdir(results_dir)
+    for ext in (".parquet", ".npy"):
+        if f"{STATS_TABLE}{ext}" in file_names:
+            return [os.path.join(results_dir, f"{STATS_TABLE}{ext}")]
+    return sorted(os.path.join(results_dir, file_name) for file_name in file_names if AGENT_FILE.match(file_name))
+
+
+def find_runs(root):
+    """
+    Every run under root, root included: directories saved by sim.py, sweep.py or Environment.simulate.
+    """
+    runs = list()
+    for directory, subdirectories, _ in os.walk(root):
+        subdirectories.sort()
+        if stats_files(directory):
+            runs.append(os.path.abspath(directory))
+    return runs
+
+
+def signature(results_dir, content_hash=False):
+    """
+    Fingerprint of the stats of a run, which changes whenever they are rewritten.
+
+    :param content_hash: Whether to hash the contents of the files. By default only their sizes and modification
+                         times are, which needs no reads but treats a rewrite with identical contents as a change
+    """
+    digest = hashlib.sha1()
+    for path in stats_files(results_dir):
+        digest.update(os.path.basename(path).encode())
+        if content_hash:
+            with open(path, "rb") as file:
+                digest.update(hashlib.sha1(file.read()).digest())
+        else:
+            info = os.stat(path)
+            digest.update(f"{info.st_size}:{info.st_mtime_ns}".encode())
+    return ("content:" if content_hash else "stat:") + digest.hexdigest()
+
+
+def index_run(results_dir):
+    """
+    Read the stats of one run and summarize them. Runs in a worker process.
+    """
+    return summarize_columns(load_columns(results_dir, workers=1))
+
+
+def load_catalog(path):
+    if not os.path.exists(path):
+        return {"version": CATALOG_VERSION, "runs": dict()}
+    with open(path, "r") as file:
+        catalog = json.load(file)
+    if catalog.get("version") != CATALOG_VERSION:
+        raise ValueError(f"{path} is a catalog of version {catalog.get('version')}, expected {CATALOG_VERSION}.")
+    return catalog
+
+
+def save_catalog(catalog, path):
+    # write next to the old catalog and swap, so an interrupted update leaves the previous one intact
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(catalog, file, indent=4)
+    os.replace(f"{path}.tmp", path)
+
+
+def update_catalog(roots, path="catalog.json", jobs=None, content_hash=False):
+    """
+    Index every run under roots into the catalog at path. Only runs that are new or whose stats changed since they
+    were last indexed are read, in parallel. Runs that were indexed under one of roots but no longer exist are dropped.
+
+    :param roots: Directories to search for runs, e.g. results/ or the out_dir of a sweep
+    :param jobs: Number of worker processes reading runs. Defaults to one per CPU
+    :param content_hash: Whether to detect changes by hashing the stats files instead of by their modification times
+    :return: (catalog, list of the runs that were read, dict mapping each run that could not be read to its error).
+             Runs that could not be read are left out of the catalog and tried again by the next update
+    """
+    catalog = load_catalog(path)
+    entries = catalog["runs"]
+
+    found = dict()
+    for root in roots:
+        # runs are named by their path relative to the parent of their root, e.g. sweep/men10_women12_..._seed0
+        parent = os.path.dirname(os.path.abspath(root))
+        for results_dir in find_runs(root):
+            found[results_dir] = os.path.relpath(results_dir, parent)
+
+    for results_dir in list(entries):
+        in_roots = any(os.path.commonpath([results_dir, os.path.abspath(root)]) == os.path.abspath(root) for root in roots)
+        if in_roots and results_dir not in found:
+            del entries[results_dir]
+
+    signatures = {results_dir: signature(results_dir, content_hash=content_hash) for results_dir in found}
+    stale = [results_dir for results_dir in found if entries.get(results_dir, {}).get("signature") != signatures[results_dir]]
+
+    failed = dict()
+    if stale:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {results_dir: pool.submit(index_run, results_dir) for results_dir in stale}
+            for results_dir, future in futures.items():
+                try:
+                    summary = future.result()
+                except Exception as error:
+                    # one unreadable run shouldn't keep the others out of the catalog
+                    failed[results_dir] = f"{type(error).__name__}: {error}"
+                    entries.pop(results_dir, None)
+                    continue
+                entries[results_dir] = {"name": found[results_dir], "signature": signatures[results_dir], "summary": summary}
+
+    save_catalog(catalog, path)
+    return catalog, [results_dir for results_dir in stale if results_dir not in failed], failed
+
+
+def catalog_rows(catalog, patterns=None):
+    """
+    One row per run of the catalog, sorted by name: its name and path followed by its summary.
+
+    :param patterns: Only keep runs whose name matches one of these shell-style patterns, e.g. 'sweep/*seed0'
+    """
+    rows = list()
+    for results_dir, entry in sorted(catalog["runs"].items(), key=lambda item: item[1]["name"]):
+        if patterns and not any(fnmatch.fnmatch(entry["name"], pattern) for pattern in patterns):
+            continue
+        rows.append({"run": entry["name"], "results_dir": results_dir, **entry["summary"]})
+    return rows
+
+
+def write_csv(rows, path):
+    fieldnames = list()
+    for row in rows:
+        fieldnames.extend(key for key in row if key not in fieldnames) # runs with other genders add columns
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def plot_metrics(rows, metrics, labels, colors, title, xlabel, path):
+    """
+    One group of horizontal bars per run, one bar per metric.
+    """
+    from visualize import figure
+    positions = np.arange(len(rows))
+    height = 0.8 / len(metrics)
+
+    fig = figure(figsize=(10, 2 + 0.3 * len(rows) * len(metrics)))
+    ax = fig.add_subplot()
+    for m, (metric, label, color) in enumerate(zip(metrics, labels, colors)):
+        values = [row.get(metric, float("nan")) for row in rows]
+        ax.barh(positions + (m - (len(metrics) - 1) / 2) * height, values, height=height, color=color, label=label)
+    ax.set_yticks(positions, [row["run"] for row in rows])
+    ax.invert_yaxis() # first run on top
+    ax.set_xlabel(xlabel)
+    ax.set_title(title)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+def compare(rows, save_to="comparisons"):
+    """
+    Plot the summaries of several runs side by side, from the catalog alone.
+    """
+    if not os.path.exists(save_to):
+        os.makedirs(save_to)
+
+    plot_metrics(rows, ["rose_acceptance_rate", "no_rose_acceptance_rate"], ["With Rose", "Without Rose"], ["#d10026", "#00752d"],
+                 "Effect of Sending Roses on Acceptance Rates", "Acceptance Rate", f"{save_to}/rose_effect.png")
+    plot_metrics(rows, ["rose_lift"], ["Rose Acceptance Rate / No-Rose Acceptance Rate"], ["#d10026"],
+                 "Rose Acceptance Lift", "Lift", f"{save_to}/rose_lift.png")
+    for direction in ("sent", "received"):
+        plot_metrics(rows, [f"man_{direction}_acceptance_rate", f"woman_{direction}_acceptance_rate"], ["Men", "Women"],
+                     ["tab:blue", "tab:orange"], f"Proposal {direction.capitalize()} Acceptance Rates by Gender", "Acceptance Rate",
+                     f"{save_to}/gender_{direction}_acceptance_rates.png")
+    plot_metrics(rows, ["desirability_sent_acceptance_corr", "desirability_received_acceptance_corr", "desirability_partner_corr"],
+                 ["Sent Acceptance Rate", "Received Acceptance Rate", "Desirability of Accepting Agents"],
+                 ["tab:blue", "tab:orange", "tab:green"], "Correlation of Desirability with Proposal Outcomes", "Pearson Correlation",
+                 f"{save_to}/desirability_correlation.png")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index many results directories into one catalog of run summaries and compare the runs.")
+    parser.add_argument("roots", type=str, nargs="*", default=["results"], help="Directories to search for runs, e.g. results or the out_dir of a sweep. Default is 'results'.")
+    parser.add_argument("--catalog", type=str, default="catalog.json", help="Catalog file to update. Default is 'catalog.json'.")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes reading new or changed runs. Default is one per CPU.")
+    parser.add_argument("--hash", action="store_true", help="Raise flag to detect changed runs by hashing their stats files instead of by modification time.")
+    parser.add_argument("--runs", type=str, nargs="+", default=None, help="Only compare runs whose name matches one of these patterns, e.g. 'sweep/*seed0'. Default is every run in the catalog.")
+    parser.add_argument("--save_to", type=str, default="comparisons", help="Directory to save the comparison plots to. Default is 'comparisons'.")
+    parser.add_argument("--csv", type=str, default=None, help="CSV file to write one summary row per compared run to. Default is none.")
+    parser.add_argument("--no_plots", action="store_true", help="Raise flag to only update the catalog.")
+    args = parser.parse_args()
+
+    for root in args.roots:
+        if not os.path.exists(root):
+            raise FileNotFoundError(f"Directory {root} not found.")
+
+    catalog, read, failed = update_catalog(args.roots, path=args.catalog, jobs=args.jobs, content_hash=args.hash)
+    for results_dir, error in failed.items():
+        print(f"Skipped {results_dir}: {error}")
+    print(f"Read {len(read)} new or changed runs, {len(catalog['runs'])} runs in {args.catalog}")
+
+    rows = catalog_rows(catalog, patterns=args.runs)
+    if args.csv:
+        write_csv(rows, args.csv)
+    if rows and not args.no_plots:
+        compare(rows, save_to=args.save_to)
@@ -1,69 +1,206 @@
 import numpy as np
-import random
 
-from stats.stats import Stats
+from environment.rng import randbelow
+from environment.storage import SparseQTable
 
 
-class Proposal:
-    def __init__(self, sender, receiver, use_rose):
-        self.sender = sender
-        self.receiver = receiver
-        self.has_rose = use_rose
-    
-    def accept(self):
-        self.accepted = True
-    
-    def reject(self):
-        self.accepted = False
+class ProposalBuffer:
+    def __init__(self, capacity):
+        """
+        Every proposal of an episode as parallel arrays, allocated once and reused across episodes.
+        Proposals are numbered in the order they were sent, and agents refer to them by that number.
+
+        :param capacity: Maximum number of proposals in an episode
+        """
+        self.sender = np.zeros(capacity, dtype=int) # index of the sender among the agents of its gender
+        self.sender_side = np.zeros(capacity, dtype=int) # see GENDERS. The receiver is on the other side
+        self.receiver = np.zeros(capacity, dtype=int)
+        self.sender_desirability = np.zeros(capacity)
+        self.receiver_desirability = np.zeros(capacity)
+        self.has_rose = np.zeros(capacity, dtype=bool)
+        self.accepted = np.zeros(capacity, dtype=bool)
+        # rewards of each proposal for its sender and its receiver, evaluated by the Environment's reward models
+        self.sent_reward = np.zeros(capacity)
+        self.received_reward = np.zeros(capacity)
+        self.size = 0 # number of proposals sent this episode
+
+    def __len__(self):
+        return self.size
+
+    def add(self, sender, receiver, use_rose):
+        """
+        Record a proposal from agent sender to agent receiver.
+
+        :return: Number of the proposal
+        """
+        i = self.size
+        self.sender[i] = sender.index
+        self.sender_side[i] = sender.side
+        self.receiver[i] = receiver.index
+        self.sender_desirability[i] = sender.desirability_score
+        self.receiver_desirability[i] = receiver.desirability_score
+        self.has_rose[i] = use_rose
+        self.accepted[i] = False
+        self.size += 1
+        return i
+
+    def clear(self):
+        self.size = 0
+
+class RunningMax:
+    def __init__(self):
+        """
+        Lazily maintained maximum of a Q-table. Updates are O(1); the table is only rescanned
+        after the entry holding the maximum drops.
+        """
+        self.value = None # None means unknown, recompute on next read
+
+    def get(self, q_table):
+        if self.value is None:
+            self.value = q_table.max()
+        return self.value
+
+    def update(self, old_q, new_q):
+        if self.value is None:
+            return
+        if new_q >= self.value:
+            self.value = new_q
+        elif old_q == self.value:
+            self.value = None
+
+    def invalidate(self):
+        self.value = None
+
+
+class GreedyAction:
+    def __init__(self):
+        """
+        Greedy action of a Q-table, i.e. its first maximum like np.argmax, kept up to date from the Q-updates.
+        Counts how often it changes, so a policy that stopped moving can be detected without rescanning the table.
+        """
+        self.entry = None # flat index of the greedy action. None means unknown, recompute on next update
+        self.value = None
+        self.changes = 0
+
+    def update(self, q_table, entry, new_q):
+        if self.entry is None:
+            self.rescan(q_table)
+        elif new_q > self.value or (new_q == self.value and entry < self.entry):
+            self.changes += entry != self.entry
+            self.entry, self.value = entry, new_q
+        elif entry == self.entry and new_q < self.value:
+            greedy = self.entry
+            self.rescan(q_table)
+            self.changes += self.entry != greedy
+
+    def rescan(self, q_table):
+        if isinstance(q_table, SparseQTable):
+            row, col = q_table.masked_argmax(())
+        else:
+            row, col = divmod(int(q_table.argmax()), q_table.shape[1])
+        self.entry = row * q_table.shape[1] + col
+        self.value = q_table[row, col]
+
+    def invalidate(self):
+        self.entry = None
+
+    def load(self, q_table, known):
+        """
+        Rebuild the greedy action of a Q-table that was overwritten, e.g. from a checkpoint. The greedy action is
+        always the table's first maximum once known, so rescanning gives exactly the one the checkpointed run had.
+
+        :param known: Whether the greedy action was known when the table was saved. Unknown ones stay unknown, so the
+                      next update finds them without counting a change, as it would have without the checkpoint
+        """
+        if known:
+            self.rescan(q_table)
+        else:
+            self.invalidate()
+
+
+GENDERS = ("man", "woman") # agents are addressed by (side, index) where side indexes into this tuple
+
+_scratch_buffers = dict()
+
+
+def scratch_buffer(num_participants):
+    """
+    Scratch space for the masked argmax in Agent.best_send_action, shared by every agent with the
+    same number of participants so it doesn't cost N^2 memory.
+    """
+    if num_participants not in _scratch_buffers:
+        _scratch_buffers[num_participants] = np.empty((num_participants, 2))
+    return _scratch_buffers[num_participants]
+
 
 class Agent:
-    def __init__(self, id, gender, num_roses, num_proposals, desirability_score, num_participants=10, learning_rate=0.1, discount_factor=0.95):
+    def __init__(self, index, gender, num_roses, num_proposals, desirability_score, num_participants=10, learning_rate=0.1, discount_factor=0.95,
+                 cache_max_q=False, send_q_table=None, receive_q_table=None):
         """
         Initialize an agent.
         
-        :param id: Unique identifier for the agent
+        :param index: Index of the agent among the agents of its gender (its row in the opposite gender's Q-tables)
         :param gender: Gender of the agent ('man' or 'woman')
         :param num_roses: Number of digital roses available to the agent
         :param num_proposals: Number of proposals the agent can send
         :param desirability_score: Desirability score of the agent
         :param num_participants: Number of participants of the opposite gender in the simulation
+        :param cache_max_q: Keep a running maximum of each Q-table instead of rescanning it on every update
+        :param send_q_table: Array of shape (num_participants, 2) to use as the send Q-table, e.g. a view into a QTableStorage,
+                             or a SparseQTable. Defaults to a new array of zeros
+        :param receive_q_table: Same for the receive Q-table
         """
-        self.id = id # format is {gender}_{i} for i <= num participants of same gender
+        if gender not in GENDERS:
+            raise ValueError(f"Gender must be one of {{man, woman}}. Received: {gender}")
+
+        self.index = index
         self.gender = gender
+        self.side = GENDERS.index(gender)
+        self.opp_side = 1 - self.side
         self.desirability_score = desirability_score  # how attractive this agent is to others
         self.num_participants = num_participants
         self.num_roses = num_roses # number of roses the agent can send
         self.roses_sent = 0
         self.num_proposals = num_proposals # number of proposals the agent can send
-        self.proposals_sent = list()
-        self.proposals_received = list()
-        self.stats = Stats()
-        self.send_q_table = np.zeros((num_participants, 2)) # row for each agent in opposite sex, col for each action in {proposal, proposal w/ rose}
-        self.receive_q_table = np.zeros((num_participants, 2)) # row for each agent in opposite sex, col for each action in {accept, reject}
+        self.num_sent = 0 # proposals sent this episode
+        self.sent = np.zeros(num_proposals, dtype=int) # their numbers in the episode's ProposalBuffer
+        self.sent_receivers = np.zeros(num_proposals, dtype=int) # and their receivers
+        self.received = list() # numbers of the proposals received this episode
+        # row for each agent in opposite sex, col for each action in {proposal, proposal w/ rose}
+        self.send_q_table = np.zeros((num_participants, 2)) if send_q_table is None else send_q_table
+        # row for each agent in opposite sex, col for each action in {accept, reject}
+        self.receive_q_table = np.zeros((num_participants, 2)) if receive_q_table is None else receive_q_table
         self.exploration_rate = 1.0
         self.learning_rate = learning_rate
         self.discount_factor = discount_factor
-        self.valid_receivers = [self.get_agent_id(self.__opp_gender(), i) for i in range(self.num_participants)]
+        self.send_q_max = RunningMax() if cache_max_q else None
+        self.receive_q_max = RunningMax() if cache_max_q else None
+        self.q_delta = 0.0 # largest absolute change of a Q-value since the environment last read it
+        self.send_greedy = GreedyAction()
+        # availability mask over the rows of send_q_table for this episode. Sparse tables skip the sent_receivers
+        # instead, so their memory stays independent of num_participants
+        self.valid_receivers = None if isinstance(self.send_q_table, SparseQTable) else np.ones(num_participants, dtype=bool)
+        self.num_valid_receivers = num_participants
     
     def __str__(self):
         return f"{self.id}, ds={self.desirability_score}"
-    
-    def __opp_gender(self):
-        return "man" if self.gender == "woman" else "woman"
-    
-    def __update_proposals_sent(self, proposal):
-        self.proposals_sent.append(proposal)
-        
-    def __update_proposals_received(self, proposal):
-        self.proposals_received.append(proposal)
-
-    def __update_valid_receivers(self, receiver_id):
-        self.valid_receivers.remove(receiver_id)
 
-    @staticmethod
-    def __q_table_max_idx(q_table):
-        # return the location of the max value in the q table
-        return np.unravel_index(np.argmax(q_table), q_table.shape)
+    @property
+    def id(self):
+        # string id, only used when writing results. format is {gender}_{i} for i <= num participants of same gender
+        return self.get_agent_id(self.gender, self.index)
+    
+    def __update_valid_receivers(self, receiver_idx):
+        if self.valid_receivers is not None:
+            self.valid_receivers[receiver_idx] = False
+        self.num_valid_receivers -= 1
+
+    def __nth_valid_receiver(self, n):
+        # skip over the (few) receivers already used this episode instead of scanning the mask
+        for used in sorted(self.sent_receivers[:self.num_sent].tolist()):
+            if used <= n:
+                n += 1
+        return n
 
     @staticmethod 
     def get_agent_id(gender, id):
@@ -74,46 +211,58 @@ class Agent:
 
     def best_send_action(self):
         has_rose = self.roses_sent < self.num_roses
-        valid_choices_q_table = list()
-        valid_idx = list()
-        # build up a subset of q table with only valid choices
-        for receiver_id in self.valid_receivers:
-            idx = int(receiver_id.split("_")[1])
-            valid_choices_q_table.append(self.send_q_table[idx][: 2 if has_rose else 1]) 
-            valid_idx.append(idx)
+        if isinstance(self.send_q_table, SparseQTable):
+            return self.send_q_table.masked_argmax(self.sent_receivers[:self.num_sent], 2 if has_rose else 1)
+
+        # mask out receivers already used this episode; they can never win the argmax
+        scores = scratch_buffer(self.num_participants)
+        scores.fill(-np.inf)
+        np.copyto(scores, self.send_q_table, where=self.valid_receivers[:, None])
         
-        max_idx = Agent.__q_table_max_idx(np.array(valid_choices_q_table))
+        if has_rose:
+            receiver_idx, action = divmod(int(np.argmax(scores)), 2)
+        else:
+            receiver_idx, action = int(np.argmax(scores[:, 0])), 0
 
-        # return the receiver id and the action
-        return (valid_idx[max_idx[0]], int(max_idx[1]))
+        # return the receiver index and the action
+        return (receiver_idx, action)
 
-    def best_receive_action(self, proposal):
+    def best_receive_action(self, proposals, i):
         # valid_choices_q_table = list()
         # valid_idx = list()
         # build up a subset of q table with only valid choices
-        sender_idx = int(proposal.sender.id.split("_")[1])
-        return np.argmax(self.receive_q_table[sender_idx])
+        return np.argmax(self.receive_q_table[proposals.sender[i]])
 
-    def send(self, proposal):
+    def send(self, proposals, i):
         """
         Process a sent proposal.
+
+        :param proposals: ProposalBuffer of the episode
+        :param i: Number of the proposal in proposals
         """
-        self.__update_valid_receivers(proposal.receiver.id)
-        self.__update_proposals_sent(proposal)
+        receiver_idx = proposals.receiver[i]
+        self.__update_valid_receivers(receiver_idx)
+        self.sent[self.num_sent] = i
+        self.sent_receivers[self.num_sent] = receiver_idx
+        self.num_sent += 1
     
-    def receive(self, proposal):
+    def receive(self, proposals, i):
         """
         Process a received proposal.
+
+        :param proposals: ProposalBuffer of the episode
+        :param i: Number of the proposal in proposals
         """
-        self.__update_proposals_received(proposal)
+        self.received.append(i)
 
-    def choose_send_action(self):
+    def choose_send_action(self, draws):
         """
         Choose an action using epsilon-greedy strategy (with exploration and exploitation).
         
-        :return: dict of format {receiver_id: str, "action": int}
+        :param draws: three uniform random numbers in [0, 1) for the exploration test, the action and the receiver
+        :return: tuple of format (receiver index, action)
         """
-        if len(self.proposals_sent) >= self.num_proposals:
+        if self.num_sent >= self.num_proposals:
             # this shouldn't happen
             raise ValueError("Limit on proposals reached")
 
@@ -121,182 +270,135 @@ class Agent:
         if self.roses_sent <= self.num_roses:
             valid_actions.append(1)
 
-        action = {"receiver_id": None, "action": None}
-        
-        if random.random() < self.exploration_rate:
-            action["action"] = random.choice(valid_actions)
-            action["receiver_id"] = random.choice(self.valid_receivers)
+        explore_draw, action_draw, receiver_draw = draws
+        if explore_draw < self.exploration_rate:
+            action = valid_actions[randbelow(action_draw, len(valid_actions))]
+            return self.__nth_valid_receiver(int(randbelow(receiver_draw, self.num_valid_receivers))), action
         
         else:
-            q_max = self.best_send_action()
-            action["receiver_id"] = self.get_agent_id(self.__opp_gender(), q_max[0])
-            action["action"] = q_max[1]
+            return self.best_send_action()
 
-        return action
-
-    def choose_receive_action(self, proposal):
+    def choose_receive_action(self, proposals, i, draws):
         """
         Choose an action using epsilon-greedy strategy.
+
+        :param proposals: ProposalBuffer of the episode
+        :param i: Number of the proposal to answer
+        :param draws: two uniform random numbers in [0, 1) for the exploration test and the action
         """
-        if len(self.proposals_received) == 0:
+        if len(self.received) == 0:
             return
         
         valid_actions = [0, 1] # 0 for reject, 1 for accept
         action = None
 
-        if random.random() < self.exploration_rate: # could have a different exploration rate for receiving
-            action = random.choice(valid_actions)
+        explore_draw, action_draw = draws
+        if explore_draw < self.exploration_rate: # could have a different exploration rate for receiving
+            action = valid_actions[randbelow(action_draw, len(valid_actions))]
         
         else:
-            action = self.best_receive_action(proposal) # this is q_max
+            action = self.best_receive_action(proposals, i) # this is q_max
 
         return action
     
-    def screen_proposals_received(self):
+    def screen_proposals_received(self, proposals, draws):
         """
         Process received proposals and update Q-table based on rewards.
+
+        :param proposals: ProposalBuffer of the episode
+        :param draws: uniform random numbers of every proposal of the episode, indexed by proposal number
         """
-        for proposal in self.proposals_received:
-            action = self.choose_receive_action(proposal)
-            if action == 1: 
-                proposal.accept() # accept if that is the chosen action
-            else:
-                proposal.reject()
+        for i in self.received:
+            # accept if that is the chosen action
+            proposals.accepted[i] = self.choose_receive_action(proposals, i, draws[i]) == 1
     
-    def __sent_proposal_reward(self, proposal):
+    def __sent_proposal_reward(self, proposals, i):
         """
-        Calculate the reward for a sent proposal.
-        :param proposal: proposal to evaluate
+        Reward for a sent proposal, see environment.rewards.
+        :param proposals: ProposalBuffer of the episode, with its rewards evaluated
+        :param i: Number of the proposal to evaluate
         """
-        if proposal.sender != self:
-            raise ValueError(f"Invalid sender. Expected {self.id}. Received {proposal.receiver.id}")
-        
-        d = proposal.receiver.desirability_score
+        if proposals.sender_side[i] != self.side or proposals.sender[i] != self.index:
+            raise ValueError(f"Invalid sender. Expected {self.id}. Received {self.get_agent_id(GENDERS[proposals.sender_side[i]], proposals.sender[i])}")
+
+        # a Python float, so float32 Q-tables compute in their own precision like Population.update_q_table
+        return proposals.sent_reward[i].item()
+
+    def received_proposal_reward(self, proposals, i):
+        """
+        Reward for a received proposal, see environment.rewards.
+        :param proposals: ProposalBuffer of the episode, with its rewards evaluated
+        :param i: Number of the proposal to evaluate
+        """
+        if proposals.sender_side[i] != self.opp_side or proposals.receiver[i] != self.index:
+            raise ValueError(f"Invalid receiver. Expected {self.id}. Received {self.get_agent_id(GENDERS[1 - proposals.sender_side[i]], proposals.receiver[i])}")
 
-        return d + (d - self.desirability_score) * 2 if proposal.accepted else - 10
+        return proposals.received_reward[i].item()
 
-    def process_matches(self, track_stats=False):
+    def process_matches(self, proposals):
         """
         Process sent proposals and update Q-table based on rewards.
+        Stats are tracked by the Environment for every agent at once.
+
+        :param proposals: ProposalBuffer of the episode
         """
-        for proposal in self.proposals_sent:
-            reward = self.__sent_proposal_reward(proposal)
-            self.update_send_q_table(proposal, reward)
-            if track_stats:
-                self.stats.track_sent(proposal)
+        for i in self.sent[:self.num_sent].tolist():
+            reward = self.__sent_proposal_reward(proposals, i)
+            self.update_send_q_table(proposals, i, reward)
         
-        for proposal in self.proposals_received:
-            reward = self.received_proposal_reward(proposal)
-            self.update_receive_q_table(proposal, reward)
-            if track_stats:
-                self.stats.track_received(proposal)
+        for i in self.received:
+            reward = self.received_proposal_reward(proposals, i)
+            self.update_receive_q_table(proposals, i, reward)
 
-    def __get_send_q_loc(self, proposal):
-        receiver_idx = int(proposal.receiver.id.split("_")[1])
-        action = 1 if proposal.has_rose else 0
-        return receiver_idx, action
+    def __get_send_q_loc(self, proposals, i):
+        action = 1 if proposals.has_rose[i] else 0
+        return proposals.receiver[i], action
 
-    def __get_receive_q_loc(self, proposal):
-        sender_idx = int(proposal.sender.id.split("_")[1])
-        action = 1 if proposal.accepted else 0
-        return sender_idx, action
+    def __get_receive_q_loc(self, proposals, i):
+        action = 1 if proposals.accepted[i] else 0
+        return proposals.sender[i], action
 
-    def update_send_q_table(self, proposal, reward):
+    def update_send_q_table(self, proposals, i, reward):
         """
         Update the send Q-table using the Q-learning formula.
         """
-        current_q_row, current_q_col = self.__get_send_q_loc(proposal)
+        current_q_row, current_q_col = self.__get_send_q_loc(proposals, i)
         current_q = self.send_q_table[current_q_row, current_q_col]
-        max_future_q = np.max(self.send_q_table)
+        max_future_q = self.send_q_max.get(self.send_q_table) if self.send_q_max else self.send_q_table.max()
         new_q = current_q + self.learning_rate * (reward + self.discount_factor * max_future_q - current_q)
         self.send_q_table[current_q_row, current_q_col] = new_q
+        self.q_delta = max(self.q_delta, abs(float(new_q - current_q)))
+        self.send_greedy.update(self.send_q_table, current_q_row * 2 + current_q_col, new_q)
+        if self.send_q_max:
+            self.send_q_max.update(current_q, new_q)
     
-    def update_receive_q_table(self, proposal, reward):
+    def update_receive_q_table(self, proposals, i, reward):
         """
         Update the receive Q-table using the Q-learning formula.
         """
-        current_q_row, current_q_col = self.__get_receive_q_loc(proposal)
+        current_q_row, current_q_col = self.__get_receive_q_loc(proposals, i)
         current_q = self.receive_q_table[current_q_row, current_q_col]
-        max_future_q = np.max(self.receive_q_table)
+        max_future_q = self.receive_q_max.get(self.receive_q_table) if self.receive_q_max else self.receive_q_table.max()
         new_q = current_q + self.learning_rate * (reward + self.discount_factor * max_future_q - current_q)
         self.receive_q_table[current_q_row, current_q_col] = new_q
+        self.q_delta = max(self.q_delta, abs(float(new_q - current_q)))
+        if self.receive_q_max:
+            self.receive_q_max.update(current_q, new_q)
     
     def reset(self):
+        if self.valid_receivers is not None:
+            self.valid_receivers[self.sent_receivers[:self.num_sent]] = True
+        self.num_valid_receivers = self.num_participants
         self.roses_sent = 0
-        self.proposals_sent = list()
-        self.proposals_received = list()
-        self.valid_receivers = [self.get_agent_id(self.__opp_gender(), i) for i in range(self.num_participants)]       
+        self.num_sent = 0
+        self.received.clear()
 
 
 class Man(Agent):
-    def __init__(self, id, num_roses, num_proposals, desirability_score, num_participants):
-        super().__init__(f"man_{id}", "man", num_roses, num_proposals, desirability_score, num_participants)
+    def __init__(self, index, num_roses, num_proposals, desirability_score, num_participants, **kwargs):
+        super().__init__(index, "man", num_roses, num_proposals, desirability_score, num_participants, **kwargs)
 
-    
-    def received_proposal_reward(self, proposal):
-        """
-        Calculate the reward for a received proposal.
-        :param proposal: proposal to evaluate
-        """
-        if proposal.receiver != self:
-            raise ValueError(f"Invalid receiver. Expected {self.id}. Received {proposal.receiver.id}")
-
-        # assumes people are increasingly selective as they are more desirable.
-        # this function is a bit arbitrary and could be changed, but it felt intuitive:
-        # an agent with desirability 40 will be open to another agent that is ~12 desirability points less than them
-        # an agent with desirability 90 will be open to another agent that is ~2 desirability points less than them
-        # openness = 2 * np.log2(102 - self.desirability_score)
-        openness = 4 + (100 - self.desirability_score) / 10
-        
-        rose_boost = 0
-        if proposal.has_rose:
-            rose_boost = openness / 2
-
-        if proposal.accepted:
-            if proposal.sender.desirability_score < self.desirability_score - (openness + rose_boost):
-                return -50
-            else:
-                return 50 + (proposal.sender.desirability_score - self.desirability_score) + rose_boost
-        
-        else:
-            if proposal.sender.desirability_score < self.desirability_score - (openness + rose_boost):
-                return 10
-            else:
-                return -30
 
 class Woman(Agent):
-    def __init__(self, id, num_roses, num_proposals, desirability_score, num_participants):
-        super().__init__(f"woman_{id}", "woman", num_roses, num_proposals, desirability_score, num_participants)
-    
-    def received_proposal_reward(self, proposal):
-        """
-        Calculate the reward for a received proposal.
-        :param proposal: proposal to evaluate
-        """
-        if proposal.receiver != self:
-            raise ValueError(f"Invalid receiver. Expected {self.id}. Received {proposal.receiver.id}")
-
-        # assumes people are increasingly selective as they are more desirable.
-        # this function is a bit arbitrary and could be changed, but it felt intuitive:
-        # an agent with desirability 40 will be open to another agent that is ~12 desirability points less than them
-        # an agent with desirability 90 will be open to another agent that is ~2 desirability points less than them
-        # openness = 2 * np.log2(102 - self.desirability_score)
-        openness = 4 + (100 - self.desirability_score) / 10
-        
-        rose_boost = 0
-        if proposal.has_rose:
-            rose_boost = openness / 2
-
-        if proposal.accepted:
-            if proposal.sender.desirability_score < self.desirability_score - (openness + rose_boost):
-                return -10
-            else:
-                return 50 + (proposal.sender.desirability_score - self.desirability_score) + rose_boost
-        
-        else:
-            if proposal.sender.desirability_score < self.desirability_score - (openness + rose_boost):
-                return 10
-            else:
-                return -10
-
-    
\ No newline at end of file
+    def __init__(self, index, num_roses, num_proposals, desirability_score, num_participants, **kwargs):
+        super().__init__(index, "woman", num_roses, num_proposals, desirability_score, num_participants, **kwargs)
@@ -0,0 +1,196 @@
+import os
+
+import numpy as np
+
+from environment.progress import progress_bar
+from environment.rng import RandomStreams
+from environment.roses import RoseSampler
+from environment.vec_env import Population, decay_exploration, learn, proposal_ranks, sent_ranks
+from stats.results import Q_TABLES, results_columns, write_results
+from stats.stats import Stats, track
+
+
+class BatchedEnvironment:
+    def __init__(self, seeds, num_men, num_women, max_proposals, rose_distribution={0.8: 2, 0.2: 6}, cache_max_q=False, q_dtype="float64",
+                 reward_models=None):
+        """
+        Many independent markets of the same size stepped together. The agents of every market share one Population
+        per gender, so each stage of an episode is one batch of array operations over all markets, instead of one per
+        market. Meant for studies that run hundreds of small markets, where per-market Python overhead dominates.
+
+        Market b draws from its own RandomStreams(seeds[b]) in the same layout as Environment and
+        VectorizedEnvironment, so its results are identical to a separate run with seed=seeds[b].
+
+        :param seeds: Seed of each market. Its length is the number of markets. None entries draw fresh entropy
+        :param num_men: Number of male agents per market
+        :param num_women: Number of female agents per market
+        :param cache_max_q: Whether to keep a running maximum of every Q-table (see Agent)
+        :param q_dtype: dtype of the Q-tables
+        :param reward_models: dict mapping a gender to the reward model of its agents, see Environment
+        """
+        if max_proposals > min(num_men, num_women):
+            raise ValueError(f"Agents cannot send {max_proposals} proposals to the {min(num_men, num_women)} agents of the opposite gender")
+        self.num_markets = len(seeds)
+        self.num_men = num_men
+        self.num_women = num_women
+        self.max_proposals = max_proposals
+        self.rose_distribution = rose_distribution
+        self.rngs = [RandomStreams(seed) for seed in seeds]
+        desirability = np.stack([rng.desirability.normal(50, 15, num_men + num_women) for rng in self.rngs])
+        self.rose_sampler = RoseSampler(rose_distribution)
+        roses = self.__draw_roses()
+        # [market, agent, agent in opposite sex, 2] per kind of table and gender
+        self.q_tables = {
+            f"{table}_{gender}": np.zeros((self.num_markets, num_agents, num_participants, 2), dtype=q_dtype)
+            for gender, num_agents, num_participants in [("man", num_men, num_women), ("woman", num_women, num_men)]
+            for table in Q_TABLES
+        }
+        # agent i of market b is row b * num_agents + i of its population. Its Q-tables index the opposite gender
+        # by their index within the market
+        self.men = Population("man", self.num_markets * num_men, num_women, max_proposals, desirability[:, :num_men].ravel(),
+                              roses[:, :num_men].ravel(), cache_max_q=cache_max_q,
+                              send_q_table=self.__rows("send_q_table", "man"), receive_q_table=self.__rows("receive_q_table", "man"),
+                              reward_model=(reward_models or {}).get("man"))
+        self.women = Population("woman", self.num_markets * num_women, num_men, max_proposals, desirability[:, num_men:].ravel(),
+                                roses[:, num_men:].ravel(), cache_max_q=cache_max_q,
+                                send_q_table=self.__rows("send_q_table", "woman"), receive_q_table=self.__rows("receive_q_table", "woman"),
+                                reward_model=(reward_models or {}).get("woman"))
+        self.proposals = list() # (sender population, receiver population, senders, receivers, has_rose) per gender
+        self.accepted = list() # whether each proposal was accepted, in the same batches as proposals
+        self.tracking = False # whether or not to track stats
+
+    def __rows(self, table, gender):
+        # a market's tables stacked under the previous market's, as one table per population
+        q_table = self.q_tables[f"{table}_{gender}"]
+        return q_table.reshape(-1, *q_table.shape[2:])
+
+    def __draw_roses(self):
+        # one block of draws per market's roses stream, sampled together
+        rand = np.stack([rng.roses.random(self.num_men + self.num_women) for rng in self.rngs])
+        return self.rose_sampler.sample(rand)
+
+    def __markets(self, agents, population):
+        # market of each row of a population
+        return agents // (population.num_agents // self.num_markets)
+
+    def reset(self):
+        """
+        Reset proposals and agents of every market for the next episode.
+        """
+        self.proposals = list()
+        self.accepted = list()
+        roses = self.__draw_roses()
+        self.men.reset(roses[:, :self.num_men].ravel())
+        self.women.reset(roses[:, self.num_men:].ravel())
+
+    def proposal_stage(self):
+        """
+        Agents of every market send proposals.
+        """
+        draws = np.stack([rng.send.random((self.num_men + self.num_women, self.max_proposals, 3)) for rng in self.rngs])
+        for sender_population, receiver_population, population_draws in [
+            (self.men, self.women, draws[:, :self.num_men]), (self.women, self.men, draws[:, self.num_men:])
+        ]:
+            senders, receivers, has_rose = sender_population.choose_send_actions(population_draws.reshape(-1, self.max_proposals, 3))
+            self.proposals.append((sender_population, receiver_population, senders, receivers, has_rose))
+
+    def response_stage(self):
+        """
+        Agents of every market receive and evaluate proposals, then update their Q-tables.
+        """
+        # each market draws for its men's proposals, then its women's, like VectorizedEnvironment.response_stage
+        counts = np.stack([np.bincount(self.__markets(senders, sender_population), minlength=self.num_markets)
+                           for sender_population, _, senders, _, _ in self.proposals], axis=1)
+        market_draws = [rng.receive.random((count, 2)) for rng, count in zip(self.rngs, counts.sum(axis=1))]
+        draws = [np.concatenate([d[:men] for d, men in zip(market_draws, counts[:, 0])]),
+                 np.concatenate([d[men:] for d, men in zip(market_draws, counts[:, 0])])]
+
+        for (sender_population, receiver_population, senders, receivers, has_rose), population_draws in zip(self.proposals, draws):
+            # rows of the receivers in their population, and index of the senders within their market
+            num_senders = sender_population.num_agents // self.num_markets
+            markets, local_senders = np.divmod(senders, num_senders)
+            receiver_rows = markets * sender_population.num_participants + receivers
+
+            accepted = receiver_population.choose_receive_actions(receiver_rows, local_senders, population_draws) == 1
+            self.accepted.append(accepted)
+
+            sender_desirability = sender_population.desirability_score[senders]
+            receiver_desirability = receiver_population.desirability_score[receiver_rows]
+
+            # senders learn from their proposals in the order they sent them
+            sent_rewards = sender_population.rewards.sent_reward(senders, receiver_desirability, has_rose, accepted)
+            learn(sender_population, sender_population.send_q_table, sender_population.send_q_max, senders, receivers, has_rose.astype(int),
+                  sent_ranks(senders, sender_population.num_agents), sent_rewards, greedy=sender_population.send_greedy)
+
+            # receivers learn from their proposals in the order they received them
+            received_rewards = receiver_population.rewards.received_reward(receiver_rows, sender_desirability, has_rose, accepted)
+            learn(receiver_population, receiver_population.receive_q_table, receiver_population.receive_q_max,
+                  receiver_rows, local_senders, accepted.astype(int), proposal_ranks(receiver_rows), received_rewards)
+
+            if self.tracking:
+                track(sender_population.stats, "sent", senders, receiver_desirability, has_rose, accepted)
+                track(receiver_population.stats, "received", receiver_rows, sender_desirability, has_rose, accepted)
+
+    def decay_exploration(self):
+        """
+        Gradually reduce every agent's exploration rate, once per episode.
+        """
+        decay_exploration([self.men, self.women])
+
+    def simulate(self, n=10, save_results=False, save_ep=8, results_dirs=None, progress=True, results_format="columnar"):
+        """
+        Run the full simulation of every market.
+        :param n: Number of episodes to run
+        :param save_results: Whether to save results to files
+        :param save_ep: Save results after this episode if saving results
+        :param results_dirs: Directory to save each market's results to. Defaults to results/market_{b}
+        :param progress: Whether to show a progress bar
+        :param results_format: 'columnar', 'legacy' (per-agent files) or 'both', see write_results
+        """
+        for episode in progress_bar(range(n), disable=not progress):  # Simulate for n episodes
+            if episode >= save_ep and save_results:
+                self.tracking = True
+
+            self.proposal_stage()
+            self.response_stage()
+            self.decay_exploration()
+            self.reset()
+
+        if save_results:
+            if results_dirs is None:
+                results_dirs = [os.path.join("results", f"market_{b}") for b in range(self.num_markets)]
+            for b, results_dir in enumerate(results_dirs):
+                write_results(results_dir, self.results_columns(b), self.market_q_tables(b), results_format=results_format)
+
+    def __market_rows(self, population, market):
+        num_agents = population.num_agents // self.num_markets
+        return slice(market * num_agents, (market + 1) * num_agents)
+
+    def stats_records(self, market):
+        """
+        Stats of every agent of one market, in the format they are saved in.
+        """
+        records = list()
+        for population in [self.men, self.women]:
+            rows = self.__market_rows(population, market)
+            stats = {field: column[rows] for field, column in population.stats.items()}
+            for i, desirability in enumerate(population.desirability_score[rows].tolist()):
+                records.append(Stats.from_columns(stats, i).to_dict(population.get_agent_id(i), desirability))
+        return records
+
+    def results_columns(self, market):
+        """
+        Stats of every agent of one market as a columnar table, see stats.results.results_columns.
+        """
+        sides = list()
+        for population in [self.men, self.women]:
+            rows = self.__market_rows(population, market)
+            sides.append((population.gender, population.desirability_score[rows],
+                          {field: column[rows] for field, column in population.stats.items()}))
+        return results_columns(sides)
+
+    def market_q_tables(self, market):
+        """
+        Q-tables of every agent of one market, stacked per gender like VectorizedEnvironment.q_tables.
+        """
+        return {name: q_table[market] for name, q_table in self.q_tables.items()}
@@ -0,0 +1,36 @@
+import json
+import os
+
+import numpy as np
+
+
+def save_checkpoint(path, episode, state):
+    """
+    Write the state of a simulation to a single .npz file. The file is written next to its destination
+    and then renamed over it, so a crash mid-write never leaves a truncated checkpoint behind.
+
+    :param path: File to write the checkpoint to
+    :param episode: Number of episodes completed, i.e. the episode to resume from
+    :param state: Arrays describing the simulation, from an engine's get_state. Its 'rng' entry holds
+                  RandomStreams.get_state() and is stored as JSON
+    """
+    arrays = {**state, "rng": json.dumps(state["rng"]), "episode": episode}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez(file, **arrays)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """
+    Read a checkpoint written by save_checkpoint.
+
+    :param path: Checkpoint file
+    :return: (episode to resume from, state to pass to an engine's set_state)
+    """
+    with np.load(path) as checkpoint:
+        state = {key: checkpoint[key] for key in checkpoint.files}
+    state["rng"] = json.loads(state["rng"].item())
+    return int(state.pop("episode")), state
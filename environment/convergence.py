@@ -0,0 +1,77 @@
+CRITERIA = ("policy_changes", "q_delta") # methods of the engines
+ON_CONVERGE = ("stop", "track")
+
+
+class ConvergenceMonitor:
+    def __init__(self, criterion="policy_changes", tolerance=0, window=100, on_converge="stop"):
+        """
+        Detects when a simulation has converged, so simulate can end it early. It reads one number per episode
+        from the environment, which keeps it up to date from the Q-updates themselves instead of comparing
+        snapshots of the Q-tables:
+
+        - 'policy_changes': number of times an agent's greedy send action (its best receiver and whether to add a rose) changed
+        - 'q_delta': largest absolute change of any Q-value. Exploration never stops entirely, so this one stays noisy
+
+        :param criterion: 'policy_changes' or 'q_delta'
+        :param tolerance: The market counts as converged once the criterion stays at or below this for window episodes
+        :param window: Number of consecutive episodes the tolerance must hold for
+        :param on_converge: 'stop' to end the simulation, or 'track' to skip straight to collecting stats:
+                            the remaining episodes are cut to the number that would have been tracked after save_ep
+        """
+        if criterion not in CRITERIA:
+            raise ValueError(f"Convergence criterion must be one of {CRITERIA}. Received: {criterion}")
+        if on_converge not in ON_CONVERGE:
+            raise ValueError(f"on_converge must be one of {ON_CONVERGE}. Received: {on_converge}")
+        self.criterion = criterion
+        self.tolerance = tolerance
+        self.window = window
+        self.on_converge = on_converge
+        self.streak = 0 # consecutive episodes within tolerance
+        self.converged_episode = None
+
+    def start(self, env):
+        """
+        Discard whatever the environment accumulated before the episodes to monitor.
+        """
+        getattr(env, self.criterion)()
+        self.streak = 0
+
+    def get_state(self):
+        """
+        Progress of the monitor, to store in a checkpoint next to the environment's state.
+        """
+        return {"convergence_streak": self.streak, "convergence_episode": -1 if self.converged_episode is None else self.converged_episode}
+
+    def set_state(self, state):
+        """
+        Continue from the progress returned by get_state. Call after start.
+        """
+        self.streak = int(state.get("convergence_streak", 0))
+        episode = int(state.get("convergence_episode", -1))
+        self.converged_episode = None if episode < 0 else episode
+
+    def update(self, env, episode):
+        """
+        Read the criterion of the episode just played.
+
+        :return: Whether the market converged with this episode
+        """
+        if self.converged_episode is not None:
+            return False
+        self.streak = self.streak + 1 if getattr(env, self.criterion)() <= self.tolerance else 0
+        if self.streak >= self.window:
+            self.converged_episode = episode
+            return True
+        return False
+
+    def stop_at(self, episode, n, save_ep, save_results):
+        """
+        Where a simulation of n episodes that converged with episode should end.
+
+        :return: (episode to end before, episode to start tracking stats on)
+        """
+        if self.on_converge == "stop" or not save_results:
+            return episode + 1, save_ep
+        if episode + 1 >= save_ep:
+            return n, save_ep # already collecting stats
+        return min(n, episode + 1 + n - save_ep), episode + 1
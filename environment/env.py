@@ -1,127 +1,395 @@
 import numpy as np
-import os
-import random
-from tqdm import tqdm
 
-from environment.agent import Man, Woman, Proposal
+from environment.agent import GENDERS, Man, Woman, ProposalBuffer
+from environment.checkpoint import load_checkpoint, save_checkpoint
+from environment.evaluation import GreedyPolicy
+from environment.progress import progress_bar
+from environment.rewards import REWARD_MODELS
+from environment.rng import RandomStreams
+from environment.roses import RoseSampler
+from environment.simulation import run_state, simulate
+from environment.storage import QTableStorage, SparseQTable
+from stats.metrics import episode_metrics
+from stats.results import Q_TABLES, load_q_tables, load_stats, results_columns, write_results
+from stats.stats import STAT_FIELDS, Stats, stat_dtype, track
 
 
 class Environment:
-    def __init__(self, num_men, num_women, max_proposals, rose_distribution={0.8: 2, 0.2: 6}):
+    def __init__(self, num_men, num_women, max_proposals, rose_distribution={0.8: 2, 0.2: 6}, cache_max_q=False, seed=None,
+                 q_dtype="float64", q_path=None, sparse_q=False, reward_models=None):
         """
         Initialize the environment.
         
         :param num_men: Number of male agents
         :param num_women: Number of female agents
+        :param cache_max_q: Whether agents keep a running maximum of their Q-tables (see Agent)
+        :param seed: Seed of the simulation's random streams. Runs with the same seed are identical
+        :param q_dtype: dtype of the Q-tables
+        :param q_path: File to memory-map the Q-tables to, see QTableStorage. None keeps them in memory
+        :param sparse_q: Give every agent SparseQTables instead of views into one dense QTableStorage, so memory
+                         scales with the interactions observed rather than with num_men * num_women
+        :param reward_models: dict mapping a gender to the RewardModel class (or any callable taking the desirability
+                              scores of its agents) that rewards its agents. Defaults to environment.rewards.REWARD_MODELS
         """
+        if sparse_q and q_path is not None:
+            raise ValueError("Sparse Q-tables cannot be memory-mapped")
+        if max_proposals > min(num_men, num_women):
+            raise ValueError(f"Agents cannot send {max_proposals} proposals to the {min(num_men, num_women)} agents of the opposite gender")
+        self.rng = RandomStreams(seed)
+        self.q_dtype = q_dtype
+        self.storage = None if sparse_q else QTableStorage(num_men, num_women, dtype=q_dtype, path=q_path)
+        desirability = self.rng.desirability.normal(50, 15, num_men + num_women).tolist()
+        self.rose_sampler = RoseSampler(rose_distribution)
+        roses = self.rose_sampler.draw(self.rng.roses, num_men + num_women).tolist()
+
         self.num_men = num_men
         self.men = [
-            Man(id=i, num_roses=self.assign_roses(d=rose_distribution), num_proposals=max_proposals, desirability_score=np.random.normal(50, 15),
-                num_participants=num_women)
+            Man(index=i, num_roses=roses[i], num_proposals=max_proposals, desirability_score=desirability[i],
+                num_participants=num_women, cache_max_q=cache_max_q, **self.__agent_q_tables("man", i, num_women))
             for i in range(num_men)
         ]
         self.num_women = num_women
         self.women = [
-            Woman(id=i, num_roses=self.assign_roses(d=rose_distribution), num_proposals=max_proposals, desirability_score=np.random.normal(50, 15),
-                  num_participants=num_men)
+            Woman(index=i, num_roses=roses[num_men + i], num_proposals=max_proposals, desirability_score=desirability[num_men + i],
+                  num_participants=num_men, cache_max_q=cache_max_q, **self.__agent_q_tables("woman", i, num_men))
             for i in range(num_women)
         ]
-        self.all_agents = {agent.id: agent for agent in self.men + self.women}
+        self.sides = [self.men, self.women] # agents are addressed by (side, index), see agent.GENDERS
+        self.reward_models = {**REWARD_MODELS, **(reward_models or {})}
+        self.__build_rewards()
         self.max_proposals = max_proposals  # Maximum proposals that can be sent
-        self.proposals = list()  # Proposals sent during the proposal stage
+        self.proposals = ProposalBuffer((num_men + num_women) * max_proposals)  # Proposals sent during the proposal stage
         self.rose_distribution = rose_distribution
         self.tracking = False # whether or not to track stats
+        # stats of every agent, men then women, tracked in bulk once per episode
+        self.stats = {field: np.zeros(num_men + num_women, dtype=stat_dtype(field)) for field in STAT_FIELDS}
+        self.run_state = None # progress of the simulate loop read from a checkpoint, see environment.simulation
+
+    def __agent_q_tables(self, gender, i, num_participants):
+        # Q-tables of one agent: views into the storage, or sparse tables of their own
+        if self.storage is None:
+            return {table: SparseQTable(num_participants, dtype=self.q_dtype) for table in Q_TABLES}
+        return {table: self.storage.table(table, gender)[i] for table in Q_TABLES}
+
+    def __build_rewards(self):
+        # one reward model per side, built from the agents' current desirability scores
+        self.rewards = [self.reward_models[gender]([agent.desirability_score for agent in side]) for gender, side in zip(GENDERS, self.sides)]
+
+    def __q_storage(self):
+        # the storage, or a dense copy of the sparse tables in the same layout
+        if self.storage is not None:
+            return self.storage
+        storage = QTableStorage(self.num_men, self.num_women, dtype=self.q_dtype)
+        for gender, side in zip(GENDERS, self.sides):
+            for table in Q_TABLES:
+                storage.table(table, gender)[:] = [getattr(agent, table).toarray() for agent in side]
+        return storage
 
     def reset(self):
         """
         Reset proposals and agents for the next episode.
         Agents' Q-tables and stats are not reset, obviously
         """
-        self.proposals = list()
-        for agent in self.men + self.women:
+        self.proposals.clear()
+        for agent, num_roses in zip(self.men + self.women, self.rose_sampler.draw(self.rng.roses, self.num_men + self.num_women).tolist()):
             agent.reset()
-            agent.num_roses = self.assign_roses(self.rose_distribution)
+            agent.num_roses = num_roses
         
 
     @staticmethod
-    def assign_roses(d={0.8: 2, 0.2: 6}):
+    def assign_roses(rand, d={0.8: 2, 0.2: 6}):
         """
         Assign roses to an agent. Default is 80% get 2 roses, 20% get 6 roses.
-        Can be changed to any distribution.
+        Can be changed to any distribution. Builds a RoseSampler on every call, so use one directly
+        to assign roses to many agents.
+
+        :param rand: uniform random number in [0, 1)
         """
-        # ensure keys of dictionary sum to 1
-        if sum(d.keys()) != 1:
-            raise ValueError("Keys of dictionary must sum to 1")
-        
-        ranges = dict() # ranges will map tuples of ranges to the number of roses they correspond to
-        prev = 0
-        for key in d:
-            ranges[(prev, prev + key)] = d[key]
-            prev += key
-        
-        rand = random.random()
-        for (lo, hi) in ranges:
-            if lo <= rand and rand < hi:
-                return ranges[(lo, hi)]
+        return RoseSampler(d).sample(rand).item()
 
     def proposal_stage(self):
         """
         Agents send proposals.
         """
-        for sender in self.men + self.women:
-            for _ in range(self.max_proposals): # currently all proposals are always used up. Could add a Q table for learning how many proposals to send?
-                action = sender.choose_send_action()
-                if action["receiver_id"]:
-                    receiver = self.all_agents[action["receiver_id"]]
-                    proposal = Proposal(sender, receiver, use_rose=action["action"] == 1)
-
-                    self.proposals.append(proposal)
-                    sender.send(proposal)
-                    receiver.receive(proposal)
+        draws = self.rng.send.random((self.num_men + self.num_women, self.max_proposals, 3)).tolist()
+        for sender, sender_draws in zip(self.men + self.women, draws):
+            for j in range(self.max_proposals): # currently all proposals are always used up. Could add a Q table for learning how many proposals to send?
+                receiver_idx, action = sender.choose_send_action(sender_draws[j])
+                if receiver_idx is not None:
+                    receiver = self.sides[sender.opp_side][receiver_idx]
+                    i = self.proposals.add(sender, receiver, use_rose=action == 1)
+                    sender.send(self.proposals, i)
+                    receiver.receive(self.proposals, i)
 
                 else:
                     print("----WARNING: No valid receiver found*************************************")
             
-            # print(f"{sender.id} sent {[(p.receiver.id, p.has_rose) for p in sender.proposals_sent]}")
             
     def response_stage(self):
         """
         Agents receive and evaluate proposals.
         """
+        draws = self.rng.receive.random((len(self.proposals), 2)).tolist()
         for agent in self.men + self.women:
-            agent.screen_proposals_received()
-        
+            agent.screen_proposals_received(self.proposals, draws)
+
+        self.__evaluate_rewards()
         for agent in self.men + self.women:
-            agent.process_matches(track_stats=self.tracking)
+            agent.process_matches(self.proposals)
+
+        if self.tracking:
+            self.__track()
+
+    def __evaluate_rewards(self):
+        # rewards of every proposal of the episode for its sender and its receiver, in one call per side and direction
+        n = len(self.proposals)
+        proposals = self.proposals
+        for side, rewards in enumerate(self.rewards):
+            sent = np.flatnonzero(proposals.sender_side[:n] == side)
+            proposals.sent_reward[sent] = rewards.sent_reward(proposals.sender[sent], proposals.receiver_desirability[sent],
+                                                              proposals.has_rose[sent], proposals.accepted[sent])
+            received = np.flatnonzero(proposals.sender_side[:n] != side)
+            proposals.received_reward[received] = rewards.received_reward(proposals.receiver[received], proposals.sender_desirability[received],
+                                                                          proposals.has_rose[received], proposals.accepted[received])
+
+    def __track(self):
+        # add every proposal of the episode to the stats of its sender and its receiver
+        n = len(self.proposals)
+        sender_side = self.proposals.sender_side[:n]
+        senders = sender_side * self.num_men + self.proposals.sender[:n]
+        receivers = (1 - sender_side) * self.num_men + self.proposals.receiver[:n]
+        has_rose = self.proposals.has_rose[:n]
+        accepted = self.proposals.accepted[:n]
+        track(self.stats, "sent", senders, self.proposals.receiver_desirability[:n], has_rose, accepted)
+        track(self.stats, "received", receivers, self.proposals.sender_desirability[:n], has_rose, accepted)
     
 
-    def simulate(self, n=10, save_results=False, save_ep=8, results_dir="results"):
+    def decay_exploration(self):
+        """
+        Gradually reduce every agent's exploration rate, once per episode.
+        """
+        for agent in self.men + self.women:
+            agent.exploration_rate = max(0.01, agent.exploration_rate * 0.995)
+
+    def simulate(self, n=10, save_results=False, save_ep=8, results_dir="results", progress=True, results_format="columnar",
+                 checkpoint_every=None, checkpoint_path="checkpoint.npz", start_episode=0, metrics_path=None, metrics_batch=100,
+                 convergence=None):
         """
         Run the full simulation.
         :param n: Number of episodes to run
         :param save_results: Whether to save results to a file
         :param save_ep: Save results after this episode if saving results
         :param results_dir: Directory to save results
+        :param progress: Whether to show a progress bar
+        :param results_format: 'columnar', 'legacy' (per-agent files) or 'both', see write_results
+        :param checkpoint_every: Write a checkpoint every this many episodes. None disables checkpointing
+        :param checkpoint_path: File to write checkpoints to
+        :param start_episode: Episode to start from, e.g. the one returned by load_checkpoint
+        :param metrics_path: JSONL file to append market-level metrics of every episode to, see stats.metrics.
+                             None disables them
+        :param metrics_batch: Number of episodes of metrics to buffer between writes
+        :param convergence: ConvergenceMonitor to end the simulation early once it converged. None always runs n episodes
         """
+        simulate(self, n, save_results=save_results, save_ep=save_ep, results_dir=results_dir, progress=progress,
+                 results_format=results_format, checkpoint_every=checkpoint_every, checkpoint_path=checkpoint_path,
+                 start_episode=start_episode, metrics_path=metrics_path, metrics_batch=metrics_batch, convergence=convergence)
 
-        for episode in tqdm(range(n)):  # Simulate for n episodes
-            # print(f"Episode {episode+1}")
-            if episode >= save_ep and save_results:
-                self.tracking = True
+    def q_delta(self):
+        """
+        Largest absolute change of any Q-value since the last call, see ConvergenceMonitor.
+        """
+        agents = self.men + self.women
+        delta = max(agent.q_delta for agent in agents)
+        for agent in agents:
+            agent.q_delta = 0.0
+        return delta
 
-            self.proposal_stage()
-            self.response_stage()
-            # Decay exploration rate
-            for agent in self.men + self.women:
-                agent.exploration_rate = max(0.01, agent.exploration_rate * 0.995)  # Gradually reduce exploration
-            
-            self.reset()
-        
+    def policy_changes(self):
+        """
+        Number of times an agent's greedy send action changed since the last call, see ConvergenceMonitor.
+        """
+        agents = self.men + self.women
+        changes = sum(agent.send_greedy.changes for agent in agents)
+        for agent in agents:
+            agent.send_greedy.changes = 0
+        return changes
+
+    def mean_q(self):
+        """
+        Mean Q-value of each kind of table over every agent.
+        """
+        if self.storage is not None:
+            return {table: self.storage.mean(table) for table in Q_TABLES}
+        num_entries = 2 * self.num_men * self.num_women * 2
+        return {table: sum(getattr(agent, table).sum() for agent in self.men + self.women) / num_entries for table in Q_TABLES}
+
+    def episode_outcomes(self):
+        """
+        Whether each proposal of the episode just played had a rose, and whether it was accepted. Call before reset.
+        """
+        n = len(self.proposals)
+        return self.proposals.has_rose[:n].copy(), self.proposals.accepted[:n].copy() # the buffer is reused next episode
+
+    def episode_metrics(self, episode):
+        """
+        Market-level metrics of the episode just played, see stats.metrics.episode_metrics. Call before reset.
+        """
+        return episode_metrics(
+            episode,
+            *self.episode_outcomes(),
+            self.mean_q(),
+            np.fromiter((agent.exploration_rate for agent in self.men + self.women), dtype=float, count=self.num_men + self.num_women),
+        )
+
+    def get_state(self):
+        """
+        Everything needed to continue the simulation exactly where it is, see environment.checkpoint.
+        Only complete between episodes.
+        """
+        agents = self.men + self.women
+        return {
+            "market": np.array([self.num_men, self.num_women, self.max_proposals]),
+            "q_tables": self.__q_storage().data,
+            "exploration_rate": np.array([agent.exploration_rate for agent in agents]),
+            "desirability_score": np.array([agent.desirability_score for agent in agents]),
+            "num_roses": np.array([agent.num_roses for agent in agents]),
+            **{f"stats_{field}": self.stats[field] for field in STAT_FIELDS},
+            "rng": self.rng.get_state(),
+            "tracking": self.tracking,
+            "send_greedy_known": np.array([agent.send_greedy.entry is not None for agent in agents]),
+        }
+
+    def set_state(self, state):
+        """
+        Restore a state returned by get_state.
+        """
+        if tuple(state["market"]) != (self.num_men, self.num_women, self.max_proposals):
+            raise ValueError(f"State of a market with (men, women, proposals) = {tuple(state['market'])} does not fit this one")
+        self.__load_q_data(state["q_tables"])
+        agents = self.men + self.women
+        for i, agent in enumerate(agents):
+            agent.exploration_rate = state["exploration_rate"][i].item()
+            agent.desirability_score = state["desirability_score"][i].item()
+            agent.num_roses = state["num_roses"][i].item()
+        self.__build_rewards()
+        for field in STAT_FIELDS:
+            self.stats[field] = state[f"stats_{field}"].astype(stat_dtype(field))
+        if "send_greedy_known" in state: # rebuild the greedy actions, so the next policy changes match the saved run's
+            for agent, known in zip(agents, state["send_greedy_known"]):
+                agent.send_greedy.load(agent.send_q_table, known)
+        self.rng.set_state(state["rng"])
+        self.tracking = bool(state["tracking"])
+        self.run_state = run_state(state)
+
+    def __load_q_data(self, data):
+        # overwrite every Q-table with data in the layout of QTableStorage.data
+        storage = self.__q_storage()
+        storage.load(data)
+        if self.storage is None:
+            for gender, side in zip(GENDERS, self.sides):
+                for table in Q_TABLES:
+                    for agent, dense in zip(side, storage.table(table, gender)):
+                        getattr(agent, table).load(dense)
+        for agent in self.men + self.women:
+            for q_max in (agent.send_q_max, agent.receive_q_max):
+                if q_max:
+                    q_max.invalidate() # the tables changed under the cache
+            agent.send_greedy.invalidate()
+
+    def load_q_tables(self, q_tables):
+        """
+        Overwrite every agent's Q-tables, e.g. with the ones saved by a previous run.
+
+        :param q_tables: dict mapping f"{table}_{gender}" to stacked Q-tables, see stats.results.load_q_tables
+        """
+        storage = QTableStorage(self.num_men, self.num_women, dtype=self.q_dtype)
+        for name, q_table in storage.tables().items():
+            q_table[:] = q_tables[name]
+        self.__load_q_data(storage.data)
+
+    @classmethod
+    def from_results(cls, results_dir, max_proposals, rose_distribution={0.8: 2, 0.2: 6}, seed=None, **kwargs):
+        """
+        Environment with the Q-tables and desirability scores of a run saved in the columnar format,
+        e.g. to evaluate the policies it learned without training again.
+
+        :param results_dir: Directory the run's results were saved to
+        :param kwargs: Passed on to Environment
+        """
+        q_tables = load_q_tables(results_dir)
+        num_men, num_women = q_tables["send_q_table_man"].shape[:2]
+        env = cls(num_men, num_women, max_proposals, rose_distribution=rose_distribution, seed=seed, **kwargs)
+        env.load_q_tables(q_tables)
+        for agent, desirability in zip(env.men + env.women, load_stats(results_dir)["desirability_score"].tolist()):
+            agent.desirability_score = desirability
+        env.__build_rewards()
+        return env
+
+    def evaluate(self, n=1000, save_results=False, results_dir="results", progress=True, results_format="columnar"):
+        """
+        Play n episodes with every agent following its greedy policy, without exploring or learning, and collect
+        the stats of every one of them. The policies are precomputed once from the frozen Q-tables, see GreedyPolicy.
+        Stats collected before are discarded.
+
+        :param n: Number of episodes to evaluate
+        :param save_results: Whether to save the stats, along with the unchanged Q-tables
+        :param results_dir: Directory to save results
+        :param progress: Whether to show a progress bar
+        :param results_format: 'columnar', 'legacy' (per-agent files) or 'both', see write_results
+        """
+        agents = self.men + self.women
+        policy = GreedyPolicy(self.q_tables(), self.num_men, self.num_women, self.max_proposals)
+        desirability = np.array([agent.desirability_score for agent in agents])
+        roses_sent = np.array([agent.roses_sent for agent in agents])
+        num_roses = np.array([agent.num_roses for agent in agents])
+        self.stats = {field: np.zeros(len(agents), dtype=stat_dtype(field)) for field in STAT_FIELDS}
+
+        for _ in progress_bar(range(n), disable=not progress):
+            senders, receivers, has_rose, accepted = policy.episode(roses_sent < num_roses) # Agent.best_send_action
+            track(self.stats, "sent", senders, desirability[receivers], has_rose, accepted)
+            track(self.stats, "received", receivers, desirability[senders], has_rose, accepted)
+            num_roses = self.rose_sampler.draw(self.rng.roses, len(agents)) # like reset
+
+        for agent, roses in zip(agents, num_roses.tolist()):
+            agent.num_roses = roses
         if save_results:
-            # make directory if it doesn't exist
-            if not os.path.exists(results_dir):
-                os.makedirs(results_dir)
-            for agent in self.men + self.women:
-                # write contents of q table to file
-                np.savetxt(f"{results_dir}/{agent.id}_q.csv", agent.send_q_table, delimiter=",")
-                agent.stats.save(agent, results_dir=results_dir)
\ No newline at end of file
+            write_results(results_dir, self.results_columns(), self.q_tables(), results_format=results_format)
+
+    def save_checkpoint(self, path, episode):
+        """
+        Write the current state to a checkpoint file, see environment.checkpoint.save_checkpoint.
+
+        :param episode: Number of episodes completed so far
+        """
+        save_checkpoint(path, episode, self.get_state())
+
+    def load_checkpoint(self, path):
+        """
+        Restore the state saved in a checkpoint file.
+
+        :return: Episode to resume from, to pass to simulate as start_episode
+        """
+        episode, state = load_checkpoint(path)
+        self.set_state(state)
+        return episode
+
+    def stats_records(self):
+        """
+        Stats of every agent, in the format they are saved in.
+        """
+        return [Stats.from_columns(self.stats, i).to_dict(agent.id, agent.desirability_score) for i, agent in enumerate(self.men + self.women)]
+
+    def results_columns(self):
+        """
+        Stats of every agent as a columnar table, see stats.results.results_columns.
+        """
+        return results_columns([
+            (gender, [agent.desirability_score for agent in side], {field: column[rows] for field, column in self.stats.items()})
+            for gender, side, rows in zip(GENDERS, self.sides, [slice(None, self.num_men), slice(self.num_men, None)])
+        ])
+
+    def q_tables(self):
+        """
+        Q-tables of every agent, stacked per gender. Sparse tables are densified.
+        """
+        return self.__q_storage().tables()
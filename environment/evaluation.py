@@ -0,0 +1,59 @@
+import numpy as np
+
+from environment.agent import GENDERS
+
+
+class GreedyPolicy:
+    def __init__(self, q_tables, num_men, num_women, num_proposals):
+        """
+        Frozen greedy policies of every agent of a market, precomputed once from their Q-tables. Without exploration
+        or learning, an agent always sends its proposals to the same receivers: those with the highest send Q-values,
+        in the order Agent.best_send_action would pick them. Each receiver's answer is then fixed too, so an episode
+        comes down to choosing between two precomputed sets of proposals per agent: with roses allowed or without.
+
+        Agents are numbered men first, then women, like Environment.stats.
+
+        :param q_tables: dict mapping f"{table}_{gender}" to stacked Q-tables, see Environment.q_tables
+        :param num_proposals: Number of proposals each agent sends
+        """
+        self.num_proposals = num_proposals
+        offsets = {"man": 0, "woman": num_men}
+        senders, receivers, has_rose, accepted = list(), {True: list(), False: list()}, {True: list(), False: list()}, {True: list(), False: list()}
+        for gender, opp_gender in zip(GENDERS, GENDERS[::-1]):
+            send_q_table = np.asarray(q_tables[f"send_q_table_{gender}"])
+            receive_q_table = np.asarray(q_tables[f"receive_q_table_{opp_gender}"])
+            agents = np.arange(len(send_q_table))
+            senders.append(np.repeat(agents + offsets[gender], num_proposals))
+
+            for allow_rose in (True, False):
+                # np.argmax over the flattened table picks the first maximum, so ties go to the lowest receiver,
+                # then to the proposal without a rose. A stable sort of each receiver's best Q-value keeps that order
+                values = send_q_table.max(axis=2) if allow_rose else send_q_table[:, :, 0]
+                ranking = np.argsort(-values, axis=1, kind="stable")[:, :num_proposals]
+                actions = send_q_table[agents[:, None], ranking].argmax(axis=2) if allow_rose else np.zeros_like(ranking)
+                # receivers accept when their receive Q-value for accepting the sender is the greedy one
+                answers = receive_q_table[ranking, agents[:, None]].argmax(axis=2) == 1
+
+                receivers[allow_rose].append(ranking.ravel() + offsets[opp_gender])
+                has_rose[allow_rose].append(actions.ravel() == 1)
+                accepted[allow_rose].append(answers.ravel())
+
+        self.senders = np.concatenate(senders)
+        self.receivers = {key: np.concatenate(value) for key, value in receivers.items()}
+        self.has_rose = {key: np.concatenate(value) for key, value in has_rose.items()}
+        self.accepted = {key: np.concatenate(value) for key, value in accepted.items()}
+
+    def episode(self, allow_rose):
+        """
+        Proposals of one episode, ordered by sender and then by rank, like Environment.proposals.
+
+        :param allow_rose: Whether each agent may send roses this episode
+        :return: (senders, receivers, has_rose, accepted) arrays with one entry per proposal
+        """
+        allow_rose = np.repeat(allow_rose, self.num_proposals)
+        return (
+            self.senders,
+            np.where(allow_rose, self.receivers[True], self.receivers[False]),
+            np.where(allow_rose, self.has_rose[True], self.has_rose[False]),
+            np.where(allow_rose, self.accepted[True], self.accepted[False]),
+        )
@@ -0,0 +1,75 @@
+import numpy as np
+
+from stats.results import Q_TABLES
+
+
+class Market:
+    def __init__(self, groups, edges=None):
+        """
+        Declarative definition of a market: its groups of agents, and which groups may propose to which.
+        For example, two pools of applicants proposing to employers, who may also approach either pool:
+
+            Market({"junior": 300, "senior": 100, "employer": 50},
+                   [("junior", "employer"), ("senior", "employer"), ("employer", "junior"), ("employer", "senior")])
+
+        :param groups: dict mapping the name of each group to its number of agents. Agents are numbered group by group,
+                       in this order
+        :param edges: list of (proposing group, receiving group) pairs. Agents may propose to every agent of every group
+                      they have an edge to. Defaults to every pair of different groups, in both directions
+        """
+        self.groups = dict(groups)
+        if edges is None:
+            edges = [(sender, receiver) for sender in self.groups for receiver in self.groups if sender != receiver]
+        self.edges = [tuple(edge) for edge in edges]
+        for sender, receiver in self.edges:
+            if sender not in self.groups or receiver not in self.groups:
+                raise ValueError(f"Edge {(sender, receiver)} connects groups that are not in the market: {list(self.groups)}")
+            if sender == receiver:
+                raise ValueError(f"Agents of {sender} cannot propose within their own group")
+        if len(set(self.edges)) != len(self.edges):
+            raise ValueError(f"Every edge must be listed once. Received: {self.edges}")
+        # groups each group proposes to, and receives proposals from, in the order of the edges
+        self.targets = {group: [receiver for sender, receiver in self.edges if sender == group] for group in self.groups}
+        self.sources = {group: [sender for sender, receiver in self.edges if receiver == group] for group in self.groups}
+
+    @classmethod
+    def two_sided(cls, num_men, num_women):
+        """
+        The market of Environment and VectorizedEnvironment: men and women proposing to each other.
+        """
+        return cls({"man": num_men, "woman": num_women}, [("man", "woman"), ("woman", "man")])
+
+    def num_agents(self):
+        return sum(self.groups.values())
+
+    def rows(self):
+        """
+        Slice of each group's agents among the agents of the whole market.
+        """
+        starts = np.cumsum([0] + list(self.groups.values())).tolist()
+        return {group: slice(start, end) for group, start, end in zip(self.groups, starts, starts[1:])}
+
+    def counterparts(self, table, group):
+        """
+        Groups making up the columns of a group's send or receive Q-table.
+
+        :param table: 'send_q_table' or 'receive_q_table'
+        """
+        return self.targets[group] if table == "send_q_table" else self.sources[group]
+
+    def width(self, groups):
+        # number of agents of groups together
+        return sum(self.groups[group] for group in groups)
+
+    def offsets(self, groups):
+        """
+        Column of the first agent of each of groups, with their agents laid out one group after the other.
+        """
+        starts = np.cumsum([0] + [self.groups[group] for group in groups]).tolist()
+        return dict(zip(groups, starts))
+
+    def num_q_values(self):
+        """
+        Number of Q-values of every agent of the market together, two kinds of tables for each edge.
+        """
+        return len(Q_TABLES) * 2 * sum(self.groups[sender] * self.groups[receiver] for sender, receiver in self.edges)
@@ -0,0 +1,120 @@
+import json
+import time
+
+import numpy as np
+
+ENVIRONMENT_STAGES = ("proposal_stage", "response_stage", "decay_exploration", "reset")
+AGENT_STAGES = ("screen_proposals_received", "process_matches")
+
+
+def agents(env):
+    # Environment's Agent objects. VectorizedEnvironment and MarketEnvironment have populations instead, without per-agent stages
+    return env.men + env.women if isinstance(getattr(env, "men", None), list) else []
+
+
+class Profiler:
+    def __init__(self, on_stage=None, on_episode=None):
+        """
+        Opt-in instrumentation of a simulation: cumulative wall time and call counts of every stage, and counts of
+        proposals, roses and acceptances per episode. It works by shadowing the methods of one environment (and of
+        its agents) with timed wrappers, so environments it is not attached to run exactly as before.
+
+        :param on_stage: Called as on_stage(stage, seconds) after every timed call
+        :param on_episode: Called as on_episode(episode, counts) after the response stage of every episode,
+                           with counts a dict of the episode's proposals, roses and acceptances
+        """
+        self.on_stage = on_stage
+        self.on_episode = on_episode
+        self.seconds = dict()
+        self.calls = dict()
+        self.episode_counts = {"proposals": list(), "roses": list(), "acceptances": list()}
+
+    def attach(self, env):
+        """
+        Start profiling env: proposal_stage, response_stage, decay_exploration, reset and, for Environment,
+        every agent's screen_proposals_received and process_matches.
+
+        :return: self
+        """
+        for stage in ENVIRONMENT_STAGES:
+            self.__wrap(env, stage)
+        for agent in agents(env):
+            for stage in AGENT_STAGES:
+                self.__wrap(agent, stage)
+
+        response_stage = env.response_stage
+        def count_outcomes():
+            response_stage()
+            self.__count(*env.episode_outcomes())
+        env.response_stage = count_outcomes
+        return self
+
+    def detach(self, env):
+        """
+        Stop profiling env, restoring its methods.
+        """
+        for obj in [env] + agents(env):
+            for stage in ENVIRONMENT_STAGES + AGENT_STAGES:
+                obj.__dict__.pop(stage, None)
+
+    def __wrap(self, obj, stage):
+        # shadow the method with a timed version, on the instance only
+        method = getattr(obj, stage)
+        self.seconds.setdefault(stage, 0.0)
+        self.calls.setdefault(stage, 0)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            self.seconds[stage] += elapsed
+            self.calls[stage] += 1
+            if self.on_stage:
+                self.on_stage(stage, elapsed)
+            return result
+
+        setattr(obj, stage, timed)
+
+    def __count(self, has_rose, accepted):
+        counts = {
+            "proposals": len(has_rose),
+            "roses": int(np.count_nonzero(has_rose)),
+            "acceptances": int(np.count_nonzero(accepted)),
+        }
+        for key, count in counts.items():
+            self.episode_counts[key].append(count)
+        if self.on_episode:
+            self.on_episode(len(self.episode_counts["proposals"]) - 1, counts)
+
+    def summary(self):
+        """
+        Totals of everything profiled so far.
+        """
+        return {
+            "episodes": len(self.episode_counts["proposals"]),
+            "stages": {
+                stage: {"seconds": self.seconds[stage], "calls": self.calls[stage],
+                        "mean_seconds": self.seconds[stage] / self.calls[stage] if self.calls[stage] else 0.0}
+                for stage in self.seconds
+            },
+            **{f"total_{key}": sum(counts) for key, counts in self.episode_counts.items()},
+            "per_episode": self.episode_counts,
+        }
+
+    def write(self, path):
+        """
+        Write the summary to a JSON file.
+        """
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=4)
+
+    def report(self):
+        """
+        Human-readable table of where the time went.
+        """
+        total = sum(self.seconds[stage] for stage in ENVIRONMENT_STAGES if stage in self.seconds)
+        lines = [f"{'stage':<28}{'seconds':>12}{'calls':>12}{'share':>8}"]
+        for stage in self.seconds:
+            share = self.seconds[stage] / total if total else 0.0
+            lines.append(f"{stage:<28}{self.seconds[stage]:>12.4f}{self.calls[stage]:>12}{share:>8.1%}")
+        return "\n".join(lines)
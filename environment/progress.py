@@ -0,0 +1,11 @@
+def progress_bar(iterable, disable=False, **kwargs):
+    """
+    tqdm(iterable, **kwargs), importing tqdm only when the bar is shown. Simulations run without one, like sweep
+    workers, never load it, which keeps their startup down to importing NumPy.
+
+    :param disable: Return iterable as is
+    """
+    if disable:
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable, **kwargs)
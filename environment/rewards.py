@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class RewardModel:
+    def __init__(self, desirability_score):
+        """
+        Rewards of the proposals sent and received by one group of agents, e.g. every agent of one gender.
+        Rewards are evaluated for whole arrays of proposals in one call, so a reward scheme costs a few array
+        operations per episode rather than a Python call per proposal. Anything that only depends on the agents
+        themselves, such as how selective they are, should be computed once here.
+
+        Subclasses implement sent_reward and received_reward. The environments take them through their
+        reward_models parameter, see REWARD_MODELS for the defaults.
+
+        :param desirability_score: Desirability score of each agent of the group
+        """
+        self.desirability_score = np.asarray(desirability_score, dtype=float)
+
+    def sent_reward(self, senders, receiver_desirability, has_rose, accepted):
+        """
+        Rewards of proposals sent by agents of the group.
+
+        :param senders: Index of the sender of each proposal within the group
+        :param receiver_desirability: Desirability score of the receiver of each proposal
+        :param has_rose: Whether each proposal had a rose
+        :param accepted: Whether each proposal was accepted
+        :return: Array of rewards, one per proposal
+        """
+        raise NotImplementedError
+
+    def received_reward(self, receivers, sender_desirability, has_rose, accepted):
+        """
+        Rewards of proposals received by agents of the group.
+
+        :param receivers: Index of the receiver of each proposal within the group
+        :param sender_desirability: Desirability score of the sender of each proposal
+        :param has_rose: Whether each proposal had a rose
+        :param accepted: Whether each proposal was accepted
+        :return: Array of rewards, one per proposal
+        """
+        raise NotImplementedError
+
+
+class SelectiveReward(RewardModel):
+    accept_too_low = -50 # reward for accepting a sender below the receiver's standards
+    reject_good = -30 # reward for rejecting a sender who meets them
+
+    def __init__(self, desirability_score):
+        """
+        The original reward scheme: senders are rewarded for matching with desirable agents, and receivers for accepting
+        senders who meet their standards and rejecting the others. A rose lowers the standards of its receiver.
+        """
+        super().__init__(desirability_score)
+        # assumes people are increasingly selective as they are more desirable.
+        # this function is a bit arbitrary and could be changed, but it felt intuitive:
+        # an agent with desirability 40 will be open to another agent that is ~12 desirability points less than them
+        # an agent with desirability 90 will be open to another agent that is ~2 desirability points less than them
+        # openness = 2 * np.log2(102 - self.desirability_score)
+        self.openness = 4 + (100 - self.desirability_score) / 10
+        self.rose_boost = self.openness / 2
+        # senders below these desirability scores are too low, without and with a rose
+        self.standard = self.desirability_score - self.openness
+        self.rose_standard = self.desirability_score - (self.openness + self.rose_boost)
+
+    def sent_reward(self, senders, receiver_desirability, has_rose, accepted):
+        return np.where(accepted, receiver_desirability + (receiver_desirability - self.desirability_score[senders]) * 2, -10)
+
+    def received_reward(self, receivers, sender_desirability, has_rose, accepted):
+        rose_boost = np.where(has_rose, self.rose_boost[receivers], 0)
+        too_low = sender_desirability < np.where(has_rose, self.rose_standard[receivers], self.standard[receivers])
+
+        accepted_reward = np.where(too_low, self.accept_too_low, 50 + (sender_desirability - self.desirability_score[receivers]) + rose_boost)
+        rejected_reward = np.where(too_low, 10, self.reject_good)
+        return np.where(accepted, accepted_reward, rejected_reward)
+
+
+class ManReward(SelectiveReward):
+    accept_too_low = -50
+    reject_good = -30
+
+
+class WomanReward(SelectiveReward):
+    accept_too_low = -10
+    reject_good = -10
+
+
+# reward model of each gender unless the environment is given others
+REWARD_MODELS = {"man": ManReward, "woman": WomanReward}
@@ -0,0 +1,39 @@
+import numpy as np
+
+
+STAGES = ("desirability", "roses", "send", "receive")
+
+
+class RandomStreams:
+    def __init__(self, seed=None):
+        """
+        Independent random number generators, one per stochastic stage of the simulation.
+        Every engine draws the same block of numbers from each stream per episode, so runs with the same seed
+        produce identical results whatever engine or process they run in.
+
+        :param seed: Seed for all streams. None draws fresh entropy from the OS
+        """
+        self.seed = seed
+        for stage, child in zip(STAGES, np.random.SeedSequence(seed).spawn(len(STAGES))):
+            setattr(self, stage, np.random.default_rng(child))
+
+    def get_state(self):
+        return {stage: getattr(self, stage).bit_generator.state for stage in STAGES}
+
+    def set_state(self, state):
+        for stage in STAGES:
+            getattr(self, stage).bit_generator.state = state[stage]
+
+
+def randbelow(u, n):
+    """
+    Map uniform draws in [0, 1) to integers in [0, n), like random.choice would. Works on scalars and arrays alike.
+    Raises ValueError if there is nothing to choose from, i.e. n < 1.
+    """
+    if isinstance(u, float) and isinstance(n, int):
+        if n < 1:
+            raise ValueError(f"Cannot choose among {n} options")
+        return min(int(u * n), n - 1) # same result without allocating NumPy scalars, for the Agent engine's per-draw calls
+    if np.any(np.less(n, 1)):
+        raise ValueError(f"Cannot choose among {np.min(n)} options")
+    return np.minimum(np.floor(np.multiply(u, n)), np.subtract(n, 1)).astype(int)
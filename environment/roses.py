@@ -0,0 +1,37 @@
+import numpy as np
+
+
+class RoseSampler:
+    def __init__(self, distribution={0.8: 2, 0.2: 6}, tolerance=1e-9):
+        """
+        Draws the number of roses of every agent from a rose distribution. Built once per simulation and shared by
+        every engine: the cumulative table is computed here, and each draw is a single searchsorted over all agents.
+
+        :param distribution: dict mapping probabilities to numbers of roses, e.g. {0.8: 2, 0.2: 6} gives 80% of
+                             agents 2 roses and 20% of them 6
+        :param tolerance: How far the probabilities may sum from 1, to allow for floating point error
+                          as in {0.7: 1, 0.2: 3, 0.1: 6}
+        """
+        probabilities = np.array(list(distribution.keys()), dtype=float)
+        if np.any(probabilities < 0) or abs(probabilities.sum() - 1) > tolerance:
+            raise ValueError(f"Keys of dictionary must be probabilities that sum to 1. Received: {distribution}")
+
+        self.distribution = distribution
+        self.edges = np.cumsum(probabilities) # upper edge of each number of roses' range in [0, 1)
+        self.roses = np.array(list(distribution.values()))
+
+    def sample(self, rand):
+        """
+        Number of roses for each uniform draw in rand. Draws past the last edge, which rounding can leave
+        just below 1, get the last number of roses.
+
+        :param rand: uniform random numbers in [0, 1), one per agent
+        """
+        idx = np.searchsorted(self.edges, rand, side="right")
+        return self.roses[np.minimum(idx, len(self.roses) - 1)]
+
+    def draw(self, rng, size):
+        """
+        Number of roses for size agents, using one uniform draw each from rng.
+        """
+        return self.sample(rng.random(size))
@@ -0,0 +1,67 @@
+import numpy as np
+
+from environment.checkpoint import save_checkpoint
+from environment.progress import progress_bar
+from stats.metrics import MetricsWriter
+from stats.results import write_results
+
+
+RUN_STATE = ("run_end", "run_save_ep", "convergence_streak", "convergence_episode") # checkpoint entries of the loop itself
+
+
+def simulate(env, n=10, save_results=False, save_ep=8, results_dir="results", progress=True, results_format="columnar",
+             checkpoint_every=None, checkpoint_path="checkpoint.npz", start_episode=0, metrics_path=None, metrics_batch=100,
+             convergence=None):
+    """
+    Training loop of Environment and MarketEnvironment, see Environment.simulate for the arguments. Checkpoints hold
+    the loop's own state next to the environment's: the convergence monitor's progress, and where the run ends and
+    starts tracking stats once convergence moved them. So a run resumed from any checkpoint plays out exactly like
+    the uninterrupted one.
+    """
+    metrics = MetricsWriter(metrics_path, batch_size=metrics_batch, start_episode=start_episode) if metrics_path else None
+    if convergence:
+        convergence.start(env)
+    end = n
+    if convergence and start_episode > 0 and env.run_state is not None:
+        convergence.set_state(env.run_state)
+        if convergence.converged_episode is not None: # otherwise the run may be resumed with a different n
+            end, save_ep = int(env.run_state["run_end"]), int(env.run_state["run_save_ep"])
+    env.run_state = None
+
+    for episode in progress_bar(range(start_episode, end), initial=start_episode, total=n, disable=not progress):  # Simulate for n episodes
+        if episode >= save_ep and save_results:
+            env.tracking = True
+
+        env.proposal_stage()
+        env.response_stage()
+        if metrics:
+            metrics.append(env.episode_metrics(episode))
+        env.decay_exploration()
+
+        env.reset()
+        # read the criterion before checkpointing, so the checkpoint holds the monitor's state after this episode
+        if convergence and convergence.update(env, episode):
+            end, save_ep = convergence.stop_at(episode, n, save_ep, save_results)
+        if checkpoint_every and (episode + 1) % checkpoint_every == 0:
+            if metrics:
+                metrics.flush() # keep the metrics file in step with the checkpoint
+            run_state = {"run_end": end, "run_save_ep": save_ep, **(convergence.get_state() if convergence else {})}
+            save_checkpoint(checkpoint_path, episode + 1, {**env.get_state(), **run_state})
+        if end < n and episode + 1 >= end:
+            break # convergence ended the run early
+
+    if env.storage is not None:
+        env.storage.flush()
+    if metrics:
+        metrics.close()
+    if save_results:
+        write_results(results_dir, env.results_columns(), env.q_tables(), results_format=results_format)
+
+
+def run_state(state):
+    """
+    Entries of a checkpoint's state that belong to the loop rather than to the environment, None if it has none.
+    """
+    if "run_end" not in state:
+        return None
+    return {key: np.asarray(state[key]).item() for key in RUN_STATE if key in state}
@@ -0,0 +1,250 @@
+import numpy as np
+
+from stats.results import Q_TABLES
+
+
+class QTableStorage:
+    def __init__(self, num_men, num_women, dtype="float64", path=None, mode="w+"):
+        """
+        Every Q-table of a simulation in one contiguous array. Agents and populations hold views into it.
+
+        :param num_men: Number of male agents
+        :param num_women: Number of female agents
+        :param dtype: dtype of the Q-values, e.g. float32 to halve memory
+        :param path: File to back the storage with an np.memmap, so markets larger than RAM can run
+                     and the learned state is on disk without copying. None keeps it in memory
+        :param mode: np.memmap mode. 'w+' creates a zeroed file, 'r+' reopens an existing one
+        """
+        self.num_men = num_men
+        self.num_women = num_women
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        # men's and women's tables both hold num_men * num_women * 2 entries
+        self.table_size = num_men * num_women * 2
+        shape = (len(Q_TABLES) * 2 * self.table_size,)
+        if path is None:
+            self.data = np.zeros(shape, dtype=self.dtype)
+        else:
+            self.data = np.memmap(path, dtype=self.dtype, mode=mode, shape=shape)
+
+    def table(self, table, gender):
+        """
+        Stacked Q-tables of every agent of a gender.
+
+        :param table: 'send_q_table' or 'receive_q_table'
+        :param gender: 'man' or 'woman'
+        :return: view of shape [agents of gender, agents of opposite gender, 2]
+        """
+        num_agents, num_participants = (self.num_men, self.num_women) if gender == "man" else (self.num_women, self.num_men)
+        start = (Q_TABLES.index(table) * 2 + (gender == "woman")) * self.table_size
+        return self.data[start:start + self.table_size].reshape(num_agents, num_participants, 2)
+
+    def tables(self):
+        """
+        Every stacked Q-table, keyed by f"{table}_{gender}".
+        """
+        return {f"{table}_{gender}": self.table(table, gender) for gender in ("man", "woman") for table in Q_TABLES}
+
+    def mean(self, table):
+        """
+        Mean Q-value of one kind of table over every agent of both genders.
+        """
+        start = Q_TABLES.index(table) * 2 * self.table_size
+        return self.data[start:start + 2 * self.table_size].mean()
+
+    def load(self, data):
+        """
+        Overwrite every Q-table with data, e.g. from a checkpoint. Views handed out by table stay valid.
+        """
+        if data.shape != self.data.shape or data.dtype != self.dtype:
+            raise ValueError(f"Q-tables of shape {data.shape} and dtype {data.dtype} do not fit a storage of shape "
+                             f"{self.data.shape} and dtype {self.dtype}")
+        self.data[:] = data
+
+    def flush(self):
+        """
+        Write the learned state to the backing file, if any.
+        """
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+
+
+class MarketQTableStorage(QTableStorage):
+    def __init__(self, market, dtype="float64", path=None, mode="w+"):
+        """
+        Every Q-table of a market with any number of groups in one contiguous array, see environment.market.Market.
+        Each group has one send table, whose columns are the agents of every group it may propose to, and one receive
+        table, whose columns are the agents of every group that may propose to it, both in the order of the market's
+        edges. So memory scales with the pairs of groups that are connected, not with every pair of agents.
+        Same interface as QTableStorage, with groups in place of genders.
+
+        :param market: Market to store the Q-tables of
+        """
+        self.market = market
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        # start of each group's tables in data, and their shape
+        self.blocks = dict()
+        size = 0
+        for table in Q_TABLES:
+            for group, num_agents in market.groups.items():
+                shape = (num_agents, market.width(market.counterparts(table, group)), 2)
+                self.blocks[table, group] = (size, shape)
+                size += int(np.prod(shape))
+        if path is None:
+            self.data = np.zeros(size, dtype=self.dtype)
+        else:
+            self.data = np.memmap(path, dtype=self.dtype, mode=mode, shape=(size,))
+
+    def table(self, table, group):
+        """
+        Stacked Q-tables of every agent of a group.
+
+        :param table: 'send_q_table' or 'receive_q_table'
+        :return: view of shape [agents of group, agents of its counterparts, 2]
+        """
+        start, shape = self.blocks[table, group]
+        return self.data[start:start + int(np.prod(shape))].reshape(shape)
+
+    def edge_table(self, table, sender, receiver):
+        """
+        Q-tables of one edge of the market: the send Q-values of the sender group for the receiver group, or the
+        receive Q-values of the receiver group for the sender group.
+
+        :return: view of shape [agents of sender, agents of receiver, 2] for send tables, and the other way around
+        """
+        group, counterpart = (sender, receiver) if table == "send_q_table" else (receiver, sender)
+        start = self.market.offsets(self.market.counterparts(table, group))[counterpart]
+        return self.table(table, group)[:, start:start + self.market.groups[counterpart]]
+
+    def tables(self):
+        """
+        Every stacked Q-table, keyed by f"{table}_{group}".
+        """
+        return {f"{table}_{group}": self.table(table, group) for group in self.market.groups for table in Q_TABLES}
+
+    def mean(self, table):
+        """
+        Mean Q-value of one kind of table over every agent of every group.
+        """
+        start = self.blocks[table, next(iter(self.market.groups))][0]
+        end = start + sum(int(np.prod(self.blocks[table, group][1])) for group in self.market.groups)
+        return self.data[start:end].mean()
+
+
+class SparseQTable:
+    def __init__(self, num_rows, num_cols=2, dtype="float64", capacity=4):
+        """
+        Drop-in for a dense np.zeros((num_rows, num_cols)) Q-table that only stores the rows that were ever written,
+        as a sorted array of row indices next to an array of their values. Every other entry reads as zero, so
+        memory scales with the counterparts an agent actually interacted with.
+
+        :param num_rows: Number of rows of the equivalent dense table, i.e. participants of the opposite gender
+        :param num_cols: Number of actions
+        :param dtype: dtype of the Q-values
+        :param capacity: Number of rows to allocate up front. Doubles whenever it runs out
+        """
+        self.shape = (num_rows, num_cols)
+        self.dtype = np.dtype(dtype)
+        self.size = 0 # number of stored rows
+        self.keys = np.empty(capacity, dtype=np.int32) # sorted indices of the stored rows
+        self.values = np.zeros((capacity, num_cols), dtype=self.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __find(self, row):
+        # position of row among the stored rows, and whether it is stored there
+        i = int(self.keys[:self.size].searchsorted(row))
+        return i, i < self.size and self.keys[i] == row
+
+    def __getitem__(self, key):
+        """
+        table[row, col] gives a Q-value, table[row] a row of Q-values. Rows never written are zeros.
+        """
+        row, col = key if isinstance(key, tuple) else (key, slice(None))
+        i, found = self.__find(row)
+        if found:
+            return self.values[i, col]
+        return self.dtype.type(0) if isinstance(key, tuple) else np.zeros(self.shape[1], dtype=self.dtype)
+
+    def __setitem__(self, key, value):
+        row, col = key
+        i, found = self.__find(row)
+        if not found:
+            self.__insert(i, row)
+        self.values[i, col] = value
+
+    def __insert(self, i, row):
+        if self.size == len(self.keys):
+            capacity = max(1, 2 * self.size)
+            self.keys = np.concatenate([self.keys, np.empty(capacity - self.size, dtype=self.keys.dtype)])
+            self.values = np.concatenate([self.values, np.zeros((capacity - self.size, self.shape[1]), dtype=self.dtype)])
+        self.keys[i + 1:self.size + 1] = self.keys[i:self.size]
+        self.values[i + 1:self.size + 1] = self.values[i:self.size]
+        self.keys[i] = row
+        self.values[i] = 0
+        self.size += 1
+
+    def max(self):
+        """
+        Maximum Q-value, counting the rows never written as zeros. Same as np.max of the dense table.
+        """
+        best = self.values[:self.size].max() if self.size else self.dtype.type(0)
+        if self.size < self.shape[0] and best < 0:
+            best = self.dtype.type(0)
+        return best
+
+    def sum(self):
+        return self.values[:self.size].sum()
+
+    def masked_argmax(self, used_rows, num_cols=None):
+        """
+        (row, col) of the largest Q-value among the rows not in used_rows and the first num_cols actions, breaking
+        ties like np.argmax of the dense table with the used rows masked to -inf. Costs O(stored rows + used rows),
+        not O(num_rows).
+
+        :param used_rows: Indices of the rows to leave out, e.g. the receivers an agent already proposed to this episode
+        :param num_cols: Number of leading actions to consider. Defaults to all
+        """
+        num_cols = self.shape[1] if num_cols is None else num_cols
+        used_rows = np.asarray(used_rows, dtype=self.keys.dtype)
+        keys = self.keys[:self.size]
+        valid = ~np.isin(keys, used_rows)
+        values = self.values[:self.size, :num_cols][valid]
+
+        best, best_position = None, 0 # np.argmax of an all -inf table
+        if values.size:
+            best = values.max()
+            # keys are sorted, so the first maximum in row-major order is the one np.argmax would pick
+            first = int(np.argmax(values == best))
+            best_position = int(keys[valid][first // num_cols]) * self.shape[1] + first % num_cols
+
+        # every row never written holds zeros, so only the first free one can win. It comes before the
+        # (stored rows + used rows + 1)-th row
+        limit = min(self.shape[0], self.size + len(used_rows) + 1)
+        taken = np.zeros(limit, dtype=bool)
+        taken[keys[keys < limit]] = True
+        taken[used_rows[used_rows < limit]] = True
+        free = np.flatnonzero(~taken)
+        if len(free) and (best is None or best < 0 or (best == 0 and free[0] * self.shape[1] < best_position)):
+            best_position = int(free[0]) * self.shape[1]
+
+        return divmod(best_position, self.shape[1])
+
+    def toarray(self):
+        """
+        The equivalent dense table.
+        """
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        dense[self.keys[:self.size]] = self.values[:self.size]
+        return dense
+
+    def load(self, dense):
+        """
+        Overwrite the table with a dense one, storing only its non-zero rows.
+        """
+        rows = np.flatnonzero(np.any(dense != 0, axis=1))
+        self.size = len(rows)
+        self.keys = rows.astype(np.int32)
+        self.values = dense[rows].astype(self.dtype)
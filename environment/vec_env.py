@@ -0,0 +1,576 @@
+import numpy as np
+
+from environment.checkpoint import load_checkpoint, save_checkpoint
+from environment.market import Market
+from environment.rewards import REWARD_MODELS, SelectiveReward
+from environment.rng import RandomStreams, randbelow
+from environment.roses import RoseSampler
+from environment.simulation import run_state, simulate
+from environment.storage import MarketQTableStorage
+from stats.metrics import episode_metrics
+from stats.results import Q_TABLES, results_columns
+from stats.stats import STAT_FIELDS, Stats, stat_dtype, track
+
+
+class RunningRowMax:
+    def __init__(self, num_agents, dtype="float64"):
+        """
+        Batched agent.RunningMax: the maximum of every agent's Q-table, rescanned only for the
+        agents whose maximum entry dropped.
+        """
+        self.value = np.zeros(num_agents, dtype=dtype)
+        self.stale = np.ones(num_agents, dtype=bool)
+
+    def get(self, q_table, agents):
+        stale = agents[self.stale[agents]]
+        if len(stale):
+            self.value[stale] = q_table.reshape(len(q_table), -1)[stale].max(axis=1)
+            self.stale[stale] = False
+        return self.value[agents]
+
+    def update(self, agents, old_q, new_q):
+        current_max = self.value[agents]
+        raised = new_q >= current_max
+        self.value[agents[raised]] = new_q[raised]
+        self.stale[agents[~raised & (old_q == current_max)]] = True
+
+    def invalidate(self):
+        self.stale[:] = True
+
+
+class RunningRowArgmax:
+    def __init__(self, num_agents, dtype="float64"):
+        """
+        Batched agent.GreedyAction: the greedy action of every agent's Q-table and a count of how often they changed.
+        """
+        self.entry = np.zeros(num_agents, dtype=int)
+        self.value = np.zeros(num_agents, dtype=dtype)
+        self.stale = np.ones(num_agents, dtype=bool)
+        self.changes = 0
+
+    def update(self, q_table, agents, entries, new_q):
+        flat = q_table.reshape(len(q_table), -1)
+        stale = self.stale[agents]
+        if stale.any():
+            # unknown greedy actions are read from the updated tables, without counting a change
+            self.__rescan(flat, agents[stale])
+            self.stale[agents[stale]] = False
+            agents, entries, new_q = agents[~stale], entries[~stale], new_q[~stale]
+
+        greedy = self.entry[agents]
+        greedy_q = self.value[agents]
+        raised = (new_q > greedy_q) | ((new_q == greedy_q) & (entries < greedy))
+        dropped = ~raised & (entries == greedy) & (new_q < greedy_q)
+        self.changes += int(np.count_nonzero(raised & (entries != greedy)))
+        self.entry[agents[raised]] = entries[raised]
+        self.value[agents[raised]] = new_q[raised]
+        if dropped.any():
+            self.__rescan(flat, agents[dropped])
+            self.changes += int(np.count_nonzero(self.entry[agents[dropped]] != greedy[dropped]))
+
+    def __rescan(self, flat, agents):
+        self.entry[agents] = flat[agents].argmax(axis=1)
+        self.value[agents] = flat[agents, self.entry[agents]]
+
+    def invalidate(self):
+        self.stale[:] = True
+
+    def load(self, q_table, known):
+        """
+        Rebuild the greedy actions of Q-tables that were overwritten, see agent.GreedyAction.load.
+
+        :param known: Whether each agent's greedy action was known when the tables were saved
+        """
+        self.stale[:] = ~known
+        self.__rescan(q_table.reshape(len(q_table), -1), np.flatnonzero(known))
+
+
+class Population:
+    def __init__(self, gender, num_agents, num_participants, num_proposals, desirability_score, num_roses, learning_rate=0.1, discount_factor=0.95,
+                 cache_max_q=False, send_q_table=None, receive_q_table=None, reward_model=None):
+        """
+        Column store for every agent of one gender, or of one group of a Market. Row i holds the state of agent {gender}_i.
+
+        :param gender: Gender of the agents ('man' or 'woman'), or name of their group
+        :param num_agents: Number of agents of this gender
+        :param num_participants: Number of agents they may propose to, e.g. of the opposite gender
+        :param num_proposals: Number of proposals each agent can send
+        :param desirability_score: Desirability score of each agent
+        :param num_roses: Number of roses of each agent for the first episode
+        :param cache_max_q: Keep a running maximum of each Q-table instead of rescanning it on every update
+        :param send_q_table: Array of shape [num_agents, num_participants, 2] to use as the send Q-tables, e.g. a view into
+                             a MarketQTableStorage. Defaults to a new array of zeros
+        :param receive_q_table: Same for the receive Q-tables
+        :param reward_model: RewardModel class (or any callable taking the desirability scores) that rewards the agents.
+                             Defaults to the one of their gender, see environment.rewards.REWARD_MODELS, and to
+                             SelectiveReward for other groups of a Market
+        """
+        self.gender = gender
+        self.num_agents = num_agents
+        self.num_participants = num_participants
+        self.reward_model = reward_model or REWARD_MODELS.get(gender, SelectiveReward)
+        self.set_desirability(desirability_score)
+        self.num_roses = num_roses
+        self.roses_sent = np.zeros(num_agents, dtype=int) # like Agent.send, roses are never counted against the budget
+        self.num_proposals = np.full(num_agents, num_proposals)
+        self.exploration_rate = np.ones(num_agents)
+        self.learning_rate = learning_rate
+        self.discount_factor = discount_factor
+        # [agent, agent in opposite sex, {proposal, proposal w/ rose}]
+        self.send_q_table = np.zeros((num_agents, num_participants, 2)) if send_q_table is None else send_q_table
+        # [agent, agent in opposite sex, {reject, accept}]
+        self.receive_q_table = np.zeros((num_agents, num_participants, 2)) if receive_q_table is None else receive_q_table
+        self.send_q_max = RunningRowMax(num_agents, self.send_q_table.dtype) if cache_max_q else None
+        self.receive_q_max = RunningRowMax(num_agents, self.receive_q_table.dtype) if cache_max_q else None
+        self.q_delta = 0.0 # largest absolute change of a Q-value since the environment last read it
+        self.send_greedy = RunningRowArgmax(num_agents, self.send_q_table.dtype)
+        self.stats = {field: np.zeros(num_agents, dtype=stat_dtype(field)) for field in STAT_FIELDS}
+
+    def set_desirability(self, desirability_score):
+        """
+        Set every agent's desirability score, and the rewards that depend on it.
+        """
+        self.desirability_score = desirability_score
+        self.rewards = self.reward_model(desirability_score)
+
+    def get_agent_id(self, i):
+        return f"{self.gender}_{i}"
+
+    def get_stats(self, i):
+        """
+        Stats object of agent i.
+        """
+        return Stats.from_columns(self.stats, i)
+
+    def choose_send_actions(self, draws):
+        """
+        Choose every proposal of every agent for one episode using an epsilon-greedy strategy.
+        Proposal j of every agent is chosen in one batched step, so receivers already picked are excluded
+        exactly like Agent.valid_receivers.
+
+        :param draws: uniform random numbers of shape [num_agents, max_proposals, 3], see Agent.choose_send_action
+
+        :return: (senders, receivers, has_rose) arrays ordered by sender, then by proposal number
+        """
+        n = self.num_agents
+        max_proposals = int(self.num_proposals.max(initial=0))
+        agents = np.arange(n)
+        receivers = np.zeros((n, max_proposals), dtype=int)
+        actions = np.zeros((n, max_proposals), dtype=int)
+        allow_rose = self.roses_sent < self.num_roses # Agent.best_send_action
+        num_valid_actions = 1 + (self.roses_sent <= self.num_roses) # Agent.choose_send_action
+
+        for j in range(max_proposals):
+            used = receivers[:, :j]
+            explore = draws[:, j, 0] < self.exploration_rate
+
+            # explore: uniform choice among the receivers not yet used this episode
+            explore_receivers = randbelow(draws[:, j, 2], self.num_participants - j)
+            for taken in np.sort(used, axis=1).T:
+                explore_receivers += taken <= explore_receivers
+            explore_actions = randbelow(draws[:, j, 1], num_valid_actions)
+
+            # exploit: masked argmax over the send q table
+            exploit_receivers = np.zeros(n, dtype=int)
+            exploit_actions = np.zeros(n, dtype=int)
+            if not explore.all():
+                exploit_receivers, exploit_actions = self.__best_send_actions(agents, used, allow_rose)
+
+            receivers[:, j] = np.where(explore, explore_receivers, exploit_receivers)
+            actions[:, j] = np.where(explore, explore_actions, exploit_actions)
+
+        sent = np.arange(max_proposals) < self.num_proposals[:, None] # proposals within each agent's budget
+        senders = np.broadcast_to(agents[:, None], sent.shape)[sent]
+        return senders, receivers[sent], actions[sent] == 1
+
+    def __best_send_actions(self, agents, used, allow_rose):
+        # temporarily mask the receivers already used this episode instead of copying the q tables
+        used_q = self.send_q_table[agents[:, None], used]
+        self.send_q_table[agents[:, None], used] = -np.inf
+
+        best = self.send_q_table.reshape(self.num_agents, -1).argmax(axis=1)
+        receivers, actions = np.divmod(best, 2)
+        no_rose = np.flatnonzero(~allow_rose)
+        if len(no_rose):
+            receivers[no_rose] = self.send_q_table[no_rose, :, 0].argmax(axis=1)
+            actions[no_rose] = 0
+
+        self.send_q_table[agents[:, None], used] = used_q
+        return receivers, actions
+
+    def choose_receive_actions(self, receivers, senders, draws):
+        """
+        Choose to accept (1) or reject (0) each proposal using an epsilon-greedy strategy.
+
+        :param draws: uniform random numbers of shape [num_proposals, 2], see Agent.choose_receive_action
+        """
+        explore = draws[:, 0] < self.exploration_rate[receivers]
+        explore_actions = randbelow(draws[:, 1], 2)
+        exploit_actions = self.receive_q_table[receivers, senders].argmax(axis=1)
+        return np.where(explore, explore_actions, exploit_actions)
+
+    def update_q_table(self, q_table, q_max, agents, rows, cols, rewards, greedy=None):
+        """
+        Batched Q-learning update. Each agent may appear at most once in agents.
+
+        :param q_max: RunningRowMax of q_table, or None to rescan the tables
+        :param greedy: RunningRowArgmax of q_table to keep up to date, if any
+        """
+        if q_max:
+            max_future_q = q_max.get(q_table, agents)
+        elif 2 * len(agents) > self.num_agents:
+            max_future_q = q_table.reshape(self.num_agents, -1).max(axis=1)[agents]
+        else:
+            max_future_q = q_table.reshape(self.num_agents, -1)[agents].max(axis=1)
+        current_q = q_table[agents, rows, cols]
+        rewards = rewards.astype(q_table.dtype) # compute in the table's precision, like Agent does with scalars
+        new_q = current_q + self.learning_rate * (rewards + self.discount_factor * max_future_q - current_q)
+        q_table[agents, rows, cols] = new_q
+        if len(agents):
+            self.q_delta = max(self.q_delta, float(np.abs(new_q - current_q).max()))
+        if greedy:
+            greedy.update(q_table, agents, rows * q_table.shape[2] + cols, new_q)
+        if q_max:
+            q_max.update(agents, current_q, new_q)
+
+    def reset(self, num_roses):
+        self.roses_sent[:] = 0
+        self.num_roses = num_roses
+
+
+def proposal_ranks(receivers):
+    """
+    Position of each proposal in its receiver's inbox, given proposals in the order they were sent.
+    """
+    order = np.argsort(receivers, kind="stable")
+    sorted_receivers = receivers[order]
+    first = np.searchsorted(sorted_receivers, sorted_receivers, side="left")
+    ranks = np.empty(len(receivers), dtype=int)
+    ranks[order] = np.arange(len(receivers)) - first
+    return ranks
+
+
+def sent_ranks(senders, num_agents):
+    """
+    Position of each proposal among its sender's proposals, given proposals ordered by sender.
+    """
+    num_sent = np.bincount(senders, minlength=num_agents)
+    return np.arange(len(senders)) - np.repeat(np.cumsum(num_sent) - num_sent, num_sent)
+
+
+def learn(population, q_table, q_max, agents, others, cols, ranks, rewards, greedy=None):
+    """
+    Apply the Q-updates of one batch of proposals, one rank at a time, so every agent
+    sees its own proposals in the same order as Agent.process_matches.
+
+    :param ranks: Position of each proposal among the proposals of its agent, see sent_ranks and proposal_ranks
+    :param greedy: RunningRowArgmax of q_table to keep up to date, if any
+    """
+    order = np.argsort(ranks, kind="stable")
+    bounds = np.cumsum(np.bincount(ranks, minlength=1))
+    for idx in np.split(order, bounds[:-1]):
+        population.update_q_table(q_table, q_max, agents[idx], others[idx], cols[idx], rewards[idx], greedy=greedy)
+
+
+def decay_exploration(populations):
+    """
+    Gradually reduce the exploration rate of every agent of populations, once per episode.
+    """
+    for population in populations:
+        population.exploration_rate = np.maximum(0.01, population.exploration_rate * 0.995)
+
+
+class MarketEnvironment:
+    def __init__(self, market, max_proposals, rose_distribution={0.8: 2, 0.2: 6}, cache_max_q=False, seed=None,
+                 q_dtype="float64", q_path=None, sparse_q=False, reward_models=None):
+        """
+        Keeps every agent's state in NumPy columns and runs each stage of an episode as batched array operations,
+        for a market with any number of groups of agents, see Market. Every group is one Population, whose send
+        Q-tables span the agents of every group it may propose to and whose receive Q-tables span the agents of every
+        group that may propose to it. Groups without outgoing edges never propose.
+
+        :param market: Market to simulate
+        :param max_proposals: Number of proposals each agent of a group with outgoing edges sends per episode
+        :param cache_max_q: Whether to keep a running maximum of every Q-table (see Agent)
+        :param seed: Seed of the simulation's random streams. The two-sided market gives the same results as Environment
+                     with the same seed
+        :param q_dtype: dtype of the Q-tables
+        :param q_path: File to memory-map the Q-tables to, see MarketQTableStorage. None keeps them in memory
+        :param sparse_q: Not supported, the populations' batched updates need dense tables. Use Environment instead
+        :param reward_models: dict mapping a group to the reward model of its agents, see environment.rewards.
+                              Groups other than 'man' and 'woman' default to SelectiveReward
+        """
+        if sparse_q:
+            raise ValueError("Sparse Q-tables are only supported by Environment")
+        for group, targets in market.targets.items():
+            if targets and max_proposals > market.width(targets):
+                raise ValueError(f"Agents of {group} cannot send {max_proposals} proposals to the {market.width(targets)} agents of {targets}")
+        self.market = market
+        self.max_proposals = max_proposals
+        self.rose_distribution = rose_distribution
+        self.rng = RandomStreams(seed)
+        self.num_agents = market.num_agents()
+        self.rows = market.rows()
+        desirability = self.rng.desirability.normal(50, 15, self.num_agents)
+        self.rose_sampler = RoseSampler(rose_distribution)
+        roses = self.rose_sampler.draw(self.rng.roses, self.num_agents)
+        self.storage = MarketQTableStorage(market, dtype=q_dtype, path=q_path)
+        self.populations = {
+            group: Population(group, num_agents, market.width(market.targets[group]), max_proposals, desirability[self.rows[group]],
+                              roses[self.rows[group]], cache_max_q=cache_max_q, send_q_table=self.storage.table("send_q_table", group),
+                              receive_q_table=self.storage.table("receive_q_table", group), reward_model=(reward_models or {}).get(group))
+            for group, num_agents in market.groups.items()
+        }
+        self.proposals = list() # (sender group, senders, receivers as columns of its send Q-tables, has_rose) per sending group
+        self.accepted = list() # whether each proposal was accepted, in the same batches as proposals
+        self.tracking = False # whether or not to track stats
+        self.run_state = None # progress of the simulate loop read from a checkpoint, see environment.simulation
+
+    def reset(self):
+        """
+        Reset proposals and agents for the next episode.
+        """
+        self.proposals = list()
+        self.accepted = list()
+        roses = self.rose_sampler.draw(self.rng.roses, self.num_agents)
+        for group, population in self.populations.items():
+            population.reset(roses[self.rows[group]])
+
+    def proposal_stage(self):
+        """
+        Agents of every group with outgoing edges send proposals.
+        """
+        draws = self.rng.send.random((self.num_agents, self.max_proposals, 3))
+        for group, population in self.populations.items():
+            if self.market.targets[group]:
+                senders, columns, has_rose = population.choose_send_actions(draws[self.rows[group]])
+                self.proposals.append((group, senders, columns, has_rose))
+
+    def response_stage(self):
+        """
+        Agents receive and evaluate proposals, then update their Q-tables.
+        """
+        # proposals are numbered in the order they were sent, like in ProposalBuffer
+        draws = self.rng.receive.random((sum(len(proposals[1]) for proposals in self.proposals), 2))
+        offset = 0
+        for group, senders, columns, has_rose in self.proposals:
+            sender_population = self.populations[group]
+            group_draws = draws[offset:offset + len(senders)]
+            offset += len(senders)
+
+            # split the proposals by the group they went to
+            targets = self.market.targets[group]
+            target_offsets = self.market.offsets(targets)
+            if len(targets) > 1:
+                target = np.searchsorted([target_offsets[receiver_group] for receiver_group in targets], columns, side="right") - 1
+            accepted = np.zeros(len(senders), dtype=bool)
+            receiver_desirability = np.zeros(len(senders))
+            inboxes = list() # (receiver population, proposals, receivers, senders as columns of their receive Q-tables)
+            for k, receiver_group in enumerate(targets):
+                idx = np.flatnonzero(target == k) if len(targets) > 1 else slice(None)
+                receiver_population = self.populations[receiver_group]
+                receivers = columns[idx] - target_offsets[receiver_group]
+                sender_columns = senders[idx] + self.market.offsets(self.market.sources[receiver_group])[group]
+                accepted[idx] = receiver_population.choose_receive_actions(receivers, sender_columns, group_draws[idx]) == 1
+                receiver_desirability[idx] = receiver_population.desirability_score[receivers]
+                inboxes.append((receiver_population, idx, receivers, sender_columns))
+            self.accepted.append(accepted)
+            sender_desirability = sender_population.desirability_score[senders]
+
+            # senders learn from their proposals in the order they sent them
+            sent_rewards = sender_population.rewards.sent_reward(senders, receiver_desirability, has_rose, accepted)
+            learn(sender_population, sender_population.send_q_table, sender_population.send_q_max, senders, columns, has_rose.astype(int),
+                  sent_ranks(senders, sender_population.num_agents), sent_rewards, greedy=sender_population.send_greedy)
+            if self.tracking:
+                track(sender_population.stats, "sent", senders, receiver_desirability, has_rose, accepted)
+
+            # receivers learn from their proposals in the order they received them
+            for receiver_population, idx, receivers, sender_columns in inboxes:
+                received_rewards = receiver_population.rewards.received_reward(receivers, sender_desirability[idx], has_rose[idx], accepted[idx])
+                learn(receiver_population, receiver_population.receive_q_table, receiver_population.receive_q_max,
+                      receivers, sender_columns, accepted[idx].astype(int), proposal_ranks(receivers), received_rewards)
+                if self.tracking:
+                    track(receiver_population.stats, "received", receivers, sender_desirability[idx], has_rose[idx], accepted[idx])
+
+    def decay_exploration(self):
+        """
+        Gradually reduce every agent's exploration rate, once per episode.
+        """
+        decay_exploration(self.populations.values())
+
+    def simulate(self, n=10, save_results=False, save_ep=8, results_dir="results", progress=True, results_format="columnar",
+                 checkpoint_every=None, checkpoint_path="checkpoint.npz", start_episode=0, metrics_path=None, metrics_batch=100,
+                 convergence=None):
+        """
+        Run the full simulation.
+        :param n: Number of episodes to run
+        :param save_results: Whether to save results to a file
+        :param save_ep: Save results after this episode if saving results
+        :param results_dir: Directory to save results
+        :param progress: Whether to show a progress bar
+        :param results_format: 'columnar', 'legacy' (per-agent files) or 'both', see write_results
+        :param checkpoint_every: Write a checkpoint every this many episodes. None disables checkpointing
+        :param checkpoint_path: File to write checkpoints to
+        :param start_episode: Episode to start from, e.g. the one returned by load_checkpoint
+        :param metrics_path: JSONL file to append market-level metrics of every episode to, see stats.metrics.
+                             None disables them
+        :param metrics_batch: Number of episodes of metrics to buffer between writes
+        :param convergence: ConvergenceMonitor to end the simulation early once it converged. None always runs n episodes
+        """
+        simulate(self, n, save_results=save_results, save_ep=save_ep, results_dir=results_dir, progress=progress,
+                 results_format=results_format, checkpoint_every=checkpoint_every, checkpoint_path=checkpoint_path,
+                 start_episode=start_episode, metrics_path=metrics_path, metrics_batch=metrics_batch, convergence=convergence)
+
+    def q_delta(self):
+        """
+        Largest absolute change of any Q-value since the last call, see ConvergenceMonitor.
+        """
+        delta = max(population.q_delta for population in self.populations.values())
+        for population in self.populations.values():
+            population.q_delta = 0.0
+        return delta
+
+    def policy_changes(self):
+        """
+        Number of times an agent's greedy send action changed since the last call, see ConvergenceMonitor.
+        """
+        changes = sum(population.send_greedy.changes for population in self.populations.values())
+        for population in self.populations.values():
+            population.send_greedy.changes = 0
+        return changes
+
+    def mean_q(self):
+        """
+        Mean Q-value of each kind of table over every agent.
+        """
+        return {table: self.storage.mean(table) for table in Q_TABLES}
+
+    def episode_outcomes(self):
+        """
+        Whether each proposal of the episode just played had a rose, and whether it was accepted. Call before reset.
+        """
+        if not self.proposals:
+            return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+        return np.concatenate([has_rose for _, _, _, has_rose in self.proposals]), np.concatenate(self.accepted)
+
+    def episode_metrics(self, episode):
+        """
+        Market-level metrics of the episode just played, see stats.metrics.episode_metrics. Call before reset.
+        """
+        return episode_metrics(
+            episode,
+            *self.episode_outcomes(),
+            self.mean_q(),
+            np.concatenate([population.exploration_rate for population in self.populations.values()]),
+        )
+
+    def get_state(self):
+        """
+        Everything needed to continue the simulation exactly where it is, in the same layout as Environment.get_state
+        with the sizes of the groups in place of the numbers of men and women, and the market's edges. Checkpoints of
+        the two-sided market can be resumed with either engine. Only complete between episodes.
+        """
+        populations = list(self.populations.values())
+        return {
+            "market": np.array(list(self.market.groups.values()) + [self.max_proposals]),
+            "edges": np.array(self.__edge_ids()).reshape(-1, 2),
+            "q_tables": self.storage.data,
+            "exploration_rate": np.concatenate([population.exploration_rate for population in populations]),
+            "desirability_score": np.concatenate([population.desirability_score for population in populations]),
+            "num_roses": np.concatenate([population.num_roses for population in populations]),
+            **{f"stats_{field}": np.concatenate([population.stats[field] for population in populations]) for field in STAT_FIELDS},
+            "rng": self.rng.get_state(),
+            "tracking": self.tracking,
+            "send_greedy_known": np.concatenate([~population.send_greedy.stale for population in populations]),
+        }
+
+    def __edge_ids(self):
+        # edges as pairs of group numbers
+        groups = list(self.market.groups)
+        return [[groups.index(sender), groups.index(receiver)] for sender, receiver in self.market.edges]
+
+    def set_state(self, state):
+        """
+        Restore a state returned by get_state, or by Environment.get_state for the two-sided market.
+        """
+        market = tuple(self.market.groups.values()) + (self.max_proposals,)
+        # Environment's states have no edges, its men and women propose to each other
+        edges = state["edges"].tolist() if "edges" in state else [[0, 1], [1, 0]]
+        if tuple(state["market"]) != market or edges != self.__edge_ids():
+            raise ValueError(f"State of a market with groups and proposals {tuple(state['market'].tolist())} does not fit this one, {market} "
+                             f"with edges {self.market.edges}")
+        self.storage.load(state["q_tables"])
+        for group, population in self.populations.items():
+            rows = self.rows[group]
+            population.exploration_rate = state["exploration_rate"][rows].copy()
+            population.set_desirability(state["desirability_score"][rows].copy())
+            population.num_roses = state["num_roses"][rows].copy()
+            for field in STAT_FIELDS:
+                population.stats[field] = state[f"stats_{field}"][rows].astype(stat_dtype(field))
+            for q_max in (population.send_q_max, population.receive_q_max):
+                if q_max:
+                    q_max.invalidate() # the tables changed under the cache
+            if "send_greedy_known" in state: # rebuild the greedy actions, so the next policy changes match the saved run's
+                population.send_greedy.load(population.send_q_table, state["send_greedy_known"][rows])
+            else:
+                population.send_greedy.invalidate()
+        self.rng.set_state(state["rng"])
+        self.tracking = bool(state["tracking"])
+        self.run_state = run_state(state)
+
+    def save_checkpoint(self, path, episode):
+        """
+        Write the current state to a checkpoint file, see environment.checkpoint.save_checkpoint.
+
+        :param episode: Number of episodes completed so far
+        """
+        save_checkpoint(path, episode, self.get_state())
+
+    def load_checkpoint(self, path):
+        """
+        Restore the state saved in a checkpoint file.
+
+        :return: Episode to resume from, to pass to simulate as start_episode
+        """
+        episode, state = load_checkpoint(path)
+        self.set_state(state)
+        return episode
+
+    def stats_records(self):
+        """
+        Stats of every agent, in the format they are saved in.
+        """
+        return [
+            population.get_stats(i).to_dict(population.get_agent_id(i), population.desirability_score[i].item())
+            for population in self.populations.values() for i in range(population.num_agents)
+        ]
+
+    def results_columns(self):
+        """
+        Stats of every agent as a columnar table, see stats.results.results_columns. Its gender column holds the groups.
+        """
+        return results_columns([(group, population.desirability_score, population.stats) for group, population in self.populations.items()])
+
+    def q_tables(self):
+        """
+        Q-tables of every agent, stacked per group, see MarketQTableStorage.
+        """
+        return self.storage.tables()
+
+
+class VectorizedEnvironment(MarketEnvironment):
+    def __init__(self, num_men, num_women, max_proposals, rose_distribution={0.8: 2, 0.2: 6}, cache_max_q=False, seed=None,
+                 q_dtype="float64", q_path=None, sparse_q=False, reward_models=None):
+        """
+        Drop-in replacement for Environment: the two-sided MarketEnvironment of men and women proposing to each other.
+
+        :param num_men: Number of male agents
+        :param num_women: Number of female agents
+        :param reward_models: dict mapping a gender to the reward model of its agents, see Environment
+        """
+        super().__init__(Market.two_sided(num_men, num_women), max_proposals, rose_distribution=rose_distribution, cache_max_q=cache_max_q,
+                         seed=seed, q_dtype=q_dtype, q_path=q_path, sparse_q=sparse_q, reward_models=reward_models)
+        self.num_men = num_men
+        self.num_women = num_women
+        self.men = self.populations["man"]
+        self.women = self.populations["woman"]
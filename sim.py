@@ -1,8 +1,14 @@
 import argparse
 import ast
 
+from environment.convergence import CRITERIA, ON_CONVERGE, ConvergenceMonitor
 from environment.env import Environment
+from environment.market import Market
+from environment.profiling import Profiler
+from environment.vec_env import MarketEnvironment, VectorizedEnvironment
+from stats.results import RESULTS_FORMATS
 
+ENGINES = {"agent": Environment, "vectorized": VectorizedEnvironment}
 
 def parse_dict(arg):
     try:
@@ -17,14 +23,55 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the simulation.")
     parser.add_argument("--num_men", type=int, default=10, help="Number of male participants. Default is 10.")
     parser.add_argument("--num_women", type=int, default=10, help="Number of women participants. Default is 10.")
+    parser.add_argument("--groups", type=parse_dict, default=None, help="Simulate a market of any number of groups instead of men and women, e.g. \"{'junior': 300, 'senior': 100, 'employer': 50}\". Maps each group to its number of agents, and replaces --num_men and --num_women. Runs on the vectorized engine. Default is men and women.")
+    parser.add_argument("--edges", type=parse_dict, default=None, help="Which groups of --groups may propose to which, e.g. \"[('junior', 'employer'), ('senior', 'employer'), ('employer', 'junior')]\". Default is every group to every other group.")
     parser.add_argument("--num_episodes", type=int, default=1000, help="Number of episodes to run. Default is 1000.")
     parser.add_argument("--max_proposals", type=int, default=3, help="Maximum number of proposals each agent can send. Default is 3.")
     parser.add_argument("--rose_distribution", type=parse_dict, default="{0.8: 2, 0.2:6}", help="Distribution of roses. Default is {0.8: 2, 0.2: 6}.")
     parser.add_argument("--save_results", action="store_true", help="Raise flag to save results")
     parser.add_argument("--save_ep", type=int, default=800, help="Episode on which to start saving results. Only used if --save_results is used. Default is 800.")
     parser.add_argument("--results_dir", type=str, default="results", help="Directory to save the results to. Default is 'results'.")
+    parser.add_argument("--engine", type=str, choices=list(ENGINES), default="agent", help="Simulation engine. 'vectorized' runs the whole population as batched array operations. Default is 'agent'.")
+    parser.add_argument("--cache_max_q", action="store_true", help="Raise flag to keep a running maximum of each Q-table instead of rescanning it on every update. Recommended for large markets.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the simulation. Runs with the same seed give identical results on either engine. Default is a random seed.")
+    parser.add_argument("--results_format", type=str, choices=RESULTS_FORMATS, default="columnar", help="Layout of the saved results: one stats table plus stacked Q-tables ('columnar'), per-agent JSON and CSV files ('legacy'), or both. Default is 'columnar'.")
+    parser.add_argument("--q_dtype", type=str, choices=["float64", "float32"], default="float64", help="Precision of the Q-tables. float32 halves their memory. Default is float64.")
+    parser.add_argument("--q_memmap", type=str, default=None, help="File to memory-map all Q-tables to, for markets larger than RAM. Default keeps them in memory.")
+    parser.add_argument("--sparse_q", action="store_true", help="Raise flag to only store the Q-table rows of agents that actually interacted. Saves memory in large markets. Agent engine only.")
+    parser.add_argument("--checkpoint_every", type=int, default=None, help="Write a checkpoint every this many episodes. Default is no checkpoints.")
+    parser.add_argument("--checkpoint", type=str, default="checkpoint.npz", help="Checkpoint file to write to and resume from. Default is 'checkpoint.npz'.")
+    parser.add_argument("--resume", action="store_true", help="Raise flag to continue the run saved in --checkpoint. Use the same settings as the original run.")
+    parser.add_argument("--metrics", type=str, default=None, help="JSONL file to write market-level metrics of every episode to, e.g. to watch convergence with visualize.py --metrics. A new run replaces the file, and --resume continues it. Default is no metrics.")
+    parser.add_argument("--profile", type=str, default=None, help="JSON file to write a profile of the run to: time spent and calls per stage, and proposals, roses and acceptances per episode. Default is no profiling.")
+    parser.add_argument("--converge", type=str, choices=CRITERIA, default=None, help="End the run early once the market converged: once no agent's greedy send action changes ('policy_changes'), or no Q-value moves by more than --converge_tol ('q_delta'), for --converge_window episodes in a row. Default always runs --num_episodes.")
+    parser.add_argument("--converge_tol", type=float, default=0, help="Tolerance of --converge. Default is 0.")
+    parser.add_argument("--converge_window", type=int, default=100, help="Number of consecutive episodes --converge_tol must hold for. Default is 100.")
+    parser.add_argument("--on_converge", type=str, choices=ON_CONVERGE, default="stop", help="What to do once converged: 'stop' right away, or 'track' stats for as many episodes as would have been tracked after --save_ep, then stop. Default is 'stop'.")
+    parser.add_argument("--evaluate", type=str, default=None, help="Directory of a run saved in the columnar format. Instead of training, play --num_episodes episodes with its learned greedy policies, without exploring or learning, and collect stats. Agent engine only. Default trains a new market.")
     args = parser.parse_args()
 
-    # run simulation
-    env = Environment(num_men=args.num_men, num_women=args.num_women, max_proposals=3)
-    env.simulate(n=args.num_episodes, save_results=args.save_results, save_ep=args.save_ep, results_dir=args.results_dir)
+    if args.evaluate:
+        # evaluate a trained market
+        env = Environment.from_results(args.evaluate, args.max_proposals, rose_distribution=args.rose_distribution, seed=args.seed,
+                                       q_dtype=args.q_dtype, sparse_q=args.sparse_q)
+        env.evaluate(n=args.num_episodes, save_results=args.save_results, results_dir=args.results_dir, results_format=args.results_format)
+    else:
+        # run simulation
+        if args.groups:
+            env = MarketEnvironment(Market(args.groups, args.edges), max_proposals=args.max_proposals, rose_distribution=args.rose_distribution,
+                                    cache_max_q=args.cache_max_q, seed=args.seed, q_dtype=args.q_dtype, q_path=args.q_memmap, sparse_q=args.sparse_q)
+        else:
+            env = ENGINES[args.engine](num_men=args.num_men, num_women=args.num_women, max_proposals=args.max_proposals,
+                                       rose_distribution=args.rose_distribution, cache_max_q=args.cache_max_q, seed=args.seed,
+                                       q_dtype=args.q_dtype, q_path=args.q_memmap, sparse_q=args.sparse_q)
+        profiler = Profiler().attach(env) if args.profile else None
+        start_episode = env.load_checkpoint(args.checkpoint) if args.resume else 0
+        convergence = ConvergenceMonitor(args.converge, args.converge_tol, args.converge_window, args.on_converge) if args.converge else None
+        env.simulate(n=args.num_episodes, save_results=args.save_results, save_ep=args.save_ep, results_dir=args.results_dir,
+                     results_format=args.results_format, checkpoint_every=args.checkpoint_every, checkpoint_path=args.checkpoint,
+                     start_episode=start_episode, metrics_path=args.metrics, convergence=convergence)
+        if convergence and convergence.converged_episode is not None:
+            print(f"Converged after episode {convergence.converged_episode}")
+        if profiler:
+            profiler.write(args.profile)
+            print(profiler.report())
@@ -0,0 +1,186 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from stats.results import is_columnar, load_stats
+from stats.stats import AVERAGE_FIELDS, STAT_FIELDS, averages, rate, stat_dtype, sums
+
+
+RECORD_FIELDS = STAT_FIELDS + AVERAGE_FIELDS + ["agent_id", "desirability_score"] # fields of Stats.save
+
+
+def read_records(paths):
+    records = list()
+    for path in paths:
+        with open(path, "r") as file:
+            records.append(json.load(file))
+    return records
+
+
+def load_columns(results_dir, workers=None):
+    """
+    Load the stats of every agent of a run at once, as one array per field. Reads the columnar stats table if the run
+    has one, and the per-agent JSON files of the legacy format otherwise, several at a time.
+
+    :param workers: Number of threads reading JSON files. Defaults to one per CPU, up to 8
+    :return: dict mapping RECORD_FIELDS and 'gender' to arrays with one entry per agent, see as_columns
+    """
+    if is_columnar(results_dir):
+        return as_columns(load_stats(results_dir))
+
+    paths = [os.path.join(results_dir, file_name) for file_name in os.listdir(results_dir) if file_name.endswith(".json")]
+    workers = workers or min(8, os.cpu_count() or 1)
+    if workers == 1:
+        return as_columns(read_records(paths))
+    # one contiguous chunk of files per thread, so the records stay in directory order
+    size = -(-len(paths) // workers)
+    chunks = [paths[i:i + size] for i in range(0, len(paths), size or 1)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return as_columns([record for records in pool.map(read_records, chunks) for record in records])
+
+
+def as_columns(data):
+    """
+    Stats of every agent of a run as columns, whether they are already columns or a list of per-agent dicts
+    as returned by load_records. Adds each agent's gender, taken from its id, if it is missing, and the sds* sums of
+    records saved before they were tracked, see stats.stats.sums.
+
+    :return: dict mapping column names to arrays with one entry per agent
+    """
+    if isinstance(data, dict):
+        columns = {name: np.asarray(column) for name, column in data.items()}
+    else:
+        dtypes = {field: stat_dtype(field) for field in STAT_FIELDS + AVERAGE_FIELDS}
+        dtypes.update({"agent_id": str, "desirability_score": float})
+        # records saved before the sds* sums were tracked only have the ads* averages
+        fields = [field for field in RECORD_FIELDS if all(field in record for record in data)]
+        columns = {field: np.array([record[field] for record in data], dtype=dtypes[field]) for field in fields}
+
+    sum_fields = [field for field in STAT_FIELDS if field.startswith("sds")]
+    if any(field not in columns for field in sum_fields):
+        columns.update(sums(columns))
+    if any(field not in columns for field in AVERAGE_FIELDS):
+        columns.update(averages(columns))
+
+    if "gender" not in columns:
+        # agent ids are f"{gender}_{index}"
+        columns["gender"] = np.array([agent_id.rsplit("_", 1)[0] for agent_id in columns["agent_id"].tolist()], dtype=str)
+    return columns
+
+
+def rates(numerator, denominator):
+    """
+    Per-agent rates, nan where the denominator is 0.
+    """
+    result = np.full(len(denominator), np.nan)
+    np.divide(numerator, denominator, out=result, where=np.asarray(denominator) > 0)
+    return result
+
+
+def rose_counts(columns, direction="sent"):
+    """
+    Proposals of every agent split by rose usage.
+
+    :param direction: 'sent' or 'received'
+    :return: dict mapping has_rose to (proposals, accepted proposals) arrays with one entry per agent
+    """
+    proposals, accepted = columns[f"proposals_{direction}"], columns[f"proposals_{direction}_accepted"]
+    roses, roses_accepted = columns[f"roses_{direction}"], columns[f"roses_{direction}_accepted"]
+    return {True: (roses, roses_accepted), False: (proposals - roses, accepted - roses_accepted)}
+
+
+def group_by(columns, values, by="gender", mask=None, groups=None):
+    """
+    Split per-agent values into groups, keeping the order of the agents within each group.
+
+    :param by: Column to group by
+    :param mask: Only keep the agents where this is True, e.g. those with a defined rate
+    :param groups: Groups to return, empty if no agent belongs to them. Defaults to every group present
+    :return: dict mapping each group to an array of its values
+    """
+    keys, values = np.asarray(columns[by]), np.asarray(values)
+    if mask is not None:
+        keys, values = keys[mask], values[mask]
+    present, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(present)))[:-1]
+    split = dict(zip(present.tolist(), np.split(values[order], bounds)))
+    if groups is None:
+        return split
+    return {group: split.get(group, values[:0]) for group in groups}
+
+
+def round_rates(values, ndigits=1):
+    """
+    Round like Python's round on every value. np.round scales by powers of ten first, which rounds some values
+    such as 0.35 the other way. Rates take few distinct values, so each of them is rounded once.
+    """
+    distinct, inverse = np.unique(values, return_inverse=True)
+    return np.array([round(value, ndigits) for value in distinct.tolist()], dtype=float)[inverse.ravel()]
+
+
+def correlation(x, y):
+    """
+    Pearson correlation of two per-agent values over the agents where both are defined, nan if it is undefined.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    keep = np.isfinite(x) & np.isfinite(y)
+    if np.count_nonzero(keep) < 2:
+        return float("nan")
+    x, y = x[keep] - x[keep].mean(), y[keep] - y[keep].mean()
+    return rate(np.dot(x, y).item(), np.sqrt(np.dot(x, x) * np.dot(y, y)).item())
+
+
+def group_sums(columns, fields, by="gender"):
+    """
+    Totals of stat columns per group, e.g. every proposal sent by men.
+
+    :return: dict mapping each group to a dict of the totals of fields
+    """
+    groups, inverse = np.unique(columns[by], return_inverse=True)
+    sums = dict()
+    for field in fields:
+        sums[field] = np.zeros(len(groups), dtype=columns[field].dtype)
+        np.add.at(sums[field], inverse, columns[field])
+    return {group: {field: sums[field][g].item() for field in fields} for g, group in enumerate(groups.tolist())}
+
+
+def summarize_columns(columns):
+    """
+    Market-level summary of one run: acceptance rates with and without roses, the lift a rose gives
+    (rose acceptance rate over no-rose acceptance rate), rose usage and acceptance rates per gender,
+    and how an agent's desirability correlates with its acceptance rates and with the desirability of its matches.
+
+    :param columns: stats of every agent of the run, see as_columns
+    :return: dict of metrics, nan where a rate is undefined
+    """
+    totals = {field: columns[field].sum().item() for field in STAT_FIELDS}
+    sent = rose_counts(totals, "sent")
+    rose_acceptance_rate = rate(sent[True][1], sent[True][0])
+    no_rose_acceptance_rate = rate(sent[False][1], sent[False][0])
+    summary = {
+        "agents": len(columns["agent_id"]),
+        "proposals_sent": totals["proposals_sent"],
+        "acceptance_rate": rate(totals["proposals_sent_accepted"], totals["proposals_sent"]),
+        "rose_usage": rate(totals["roses_sent"], totals["proposals_sent"]),
+        "rose_acceptance_rate": rose_acceptance_rate,
+        "no_rose_acceptance_rate": no_rose_acceptance_rate,
+        "rose_lift": rate(rose_acceptance_rate, no_rose_acceptance_rate),
+    }
+
+    for group, group_totals in group_sums(columns, STAT_FIELDS, by="gender").items():
+        summary[f"{group}_rose_usage"] = rate(group_totals["roses_sent"], group_totals["proposals_sent"])
+        for direction in ("sent", "received"):
+            summary[f"{group}_{direction}_acceptance_rate"] = rate(group_totals[f"proposals_{direction}_accepted"],
+                                                                   group_totals[f"proposals_{direction}"])
+
+    desirability = columns["desirability_score"]
+    for direction in ("sent", "received"):
+        summary[f"desirability_{direction}_acceptance_corr"] = correlation(
+            desirability, rates(columns[f"proposals_{direction}_accepted"], columns[f"proposals_{direction}"]))
+    # average desirability of the agents who accepted each agent's proposals
+    partners = rates(columns["sdsr_sent_accepted"] + columns["sdsnr_sent_accepted"], columns["proposals_sent_accepted"])
+    summary["desirability_partner_corr"] = correlation(desirability, partners)
+    return summary
@@ -0,0 +1,137 @@
+import json
+import os
+
+import numpy as np
+
+from stats.stats import rate
+
+
+METRIC_FIELDS = ("episode", "proposals", "matches", "acceptance_rate", "rose_usage", "rose_acceptance_rate",
+                 "no_rose_acceptance_rate", "mean_send_q", "mean_receive_q", "exploration_rate")
+
+
+def episode_metrics(episode, has_rose, accepted, mean_q, exploration_rate):
+    """
+    Market-level metrics of one episode, computed over arrays rather than per agent.
+
+    :param episode: Episode number
+    :param has_rose: Whether each proposal of the episode had a rose attached
+    :param accepted: Whether each proposal of the episode was accepted
+    :param mean_q: dict mapping 'send_q_table' and 'receive_q_table' to the mean Q-value over every agent
+    :param exploration_rate: Exploration rate of every agent
+    """
+    has_rose = np.asarray(has_rose, dtype=bool)
+    accepted = np.asarray(accepted, dtype=bool)
+    proposals = len(has_rose)
+    matches = int(np.count_nonzero(accepted))
+    roses = int(np.count_nonzero(has_rose))
+    rose_matches = int(np.count_nonzero(accepted & has_rose))
+    return {
+        "episode": episode,
+        "proposals": proposals,
+        "matches": matches, # every accepted proposal is a match
+        "acceptance_rate": rate(matches, proposals),
+        "rose_usage": rate(roses, proposals),
+        "rose_acceptance_rate": rate(rose_matches, roses),
+        "no_rose_acceptance_rate": rate(matches - rose_matches, proposals - roses),
+        "mean_send_q": float(mean_q["send_q_table"]),
+        "mean_receive_q": float(mean_q["receive_q_table"]),
+        "exploration_rate": float(np.mean(exploration_rate)),
+    }
+
+
+class MetricsWriter:
+    def __init__(self, path, batch_size=100, start_episode=0):
+        """
+        Appends per-episode metrics to a JSONL file, one line per episode. Rows are buffered in a fixed-size
+        array and written a batch at a time, so memory stays bounded however long the run is.
+
+        :param path: File to write to. A new run (start_episode 0) replaces whatever it held
+        :param batch_size: Number of episodes to buffer between writes
+        :param start_episode: Episode a resumed run starts from. Batches are written whenever the buffer fills, so the
+                              file can hold episodes past the checkpoint it resumes from. They are dropped, see truncate
+        """
+        self.path = path
+        self.buffer = np.empty(batch_size, dtype=[(field, float) for field in METRIC_FIELDS])
+        self.size = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        if start_episode == 0:
+            open(path, "w").close() # a previous run's episodes would be read as this run's
+        elif os.path.exists(path):
+            truncate(path, start_episode)
+
+    def append(self, metrics):
+        """
+        Buffer the metrics of one episode, see episode_metrics.
+        """
+        self.buffer[self.size] = tuple(metrics[field] for field in METRIC_FIELDS)
+        self.size += 1
+        if self.size == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """
+        Append the buffered episodes to the file.
+        """
+        if self.size == 0:
+            return
+        lines = []
+        for row in self.buffer[:self.size].tolist():
+            record = dict(zip(METRIC_FIELDS, row))
+            record["episode"] = int(record["episode"])
+            record["proposals"] = int(record["proposals"])
+            record["matches"] = int(record["matches"])
+            lines.append(json.dumps(record) + "\n")
+        with open(self.path, "a") as file:
+            file.writelines(lines)
+        self.size = 0
+
+    def close(self):
+        self.flush()
+
+
+def truncate(path, start_episode):
+    """
+    Cut a metrics file back to the end of the last run of episodes leading up to start_episode, i.e. right after
+    the last line of episode start_episode - 1. Files without that episode are left as they are.
+    """
+    end = None
+    offset = 0
+    with open(path, "rb") as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                break # partially written
+            offset += len(line)
+            if json.loads(line)["episode"] == start_episode - 1:
+                end = offset
+    if end is not None:
+        with open(path, "r+b") as file:
+            file.truncate(end)
+
+
+def read_metrics(path, offset=0):
+    """
+    Read the episodes appended to a metrics file since offset. Only complete lines are read, so the file can be
+    tailed while a simulation is still writing to it.
+
+    :param offset: Byte offset to start reading from, e.g. the one returned by the previous call
+    :return: (list of per-episode metrics dicts, offset to continue from)
+    """
+    records = []
+    with open(path, "rb") as file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b"\n"):
+                break # partially written, picked up by the next call
+            records.append(json.loads(line))
+            offset += len(line)
+    return records, offset
+
+
+def metrics_columns(records):
+    """
+    Turn per-episode metrics dicts into a dict of arrays, one per metric.
+    """
+    return {field: np.array([record[field] for record in records], dtype=float) for field in METRIC_FIELDS}
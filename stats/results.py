@@ -0,0 +1,149 @@
+import json
+import os
+
+import numpy as np
+
+from stats.stats import AVERAGE_FIELDS, STAT_FIELDS, averages, stat_dtype
+
+
+STATS_TABLE = "stats" # stats.parquet, or stats.npy when pyarrow is not installed
+Q_TABLES = ("send_q_table", "receive_q_table")
+RESULTS_FORMATS = ("columnar", "legacy", "both")
+
+
+def results_columns(sides):
+    """
+    Build the columnar stats table of a run.
+
+    :param sides: list of (gender, desirability scores, {stat field: values}) tuples, one per gender
+    :return: dict mapping column names to arrays with one entry per agent
+    """
+    columns = {
+        "agent_id": np.array([f"{gender}_{i}" for gender, desirability, _ in sides for i in range(len(desirability))]),
+        "gender": np.array([gender for gender, desirability, _ in sides for _ in range(len(desirability))]),
+        "index": np.concatenate([np.arange(len(desirability)) for _, desirability, _ in sides]),
+        "desirability_score": np.concatenate([np.asarray(desirability, dtype=float) for _, desirability, _ in sides]),
+    }
+    for field in STAT_FIELDS:
+        columns[field] = np.concatenate([np.asarray(stats[field], dtype=stat_dtype(field)) for _, _, stats in sides])
+    columns.update(averages(columns))
+    return columns
+
+
+def write_results(results_dir, columns, q_tables, results_format="columnar"):
+    """
+    Write the results of a run.
+
+    :param columns: stats table, see results_columns
+    :param q_tables: dict mapping f"{table}_{gender}" to the stacked Q-tables of every agent of that gender
+    :param results_format: 'columnar' for one stats table plus one .npy per Q-table kind and gender,
+                           'legacy' for one {id}.json and {id}_q.csv per agent, or 'both'
+    """
+    if results_format not in RESULTS_FORMATS:
+        raise ValueError(f"Results format must be one of {RESULTS_FORMATS}. Received: {results_format}")
+
+    # make directory if it doesn't exist
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+
+    if results_format in ("columnar", "both"):
+        write_stats_table(os.path.join(results_dir, STATS_TABLE), columns)
+        for name, q_table in q_tables.items():
+            np.save(os.path.join(results_dir, f"{name}.npy"), q_table)
+
+    if results_format in ("legacy", "both"):
+        write_legacy(results_dir, columns, q_tables)
+
+
+def write_stats_table(path, columns):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        table = np.empty(len(columns["agent_id"]), dtype=[(name, column.dtype) for name, column in columns.items()])
+        for name, column in columns.items():
+            table[name] = column
+        np.save(f"{path}.npy", table)
+    else:
+        pq.write_table(pa.table(columns), f"{path}.parquet")
+
+
+def write_legacy(results_dir, columns, q_tables):
+    """
+    Write one {id}.json (see Stats.save) and one {id}_q.csv with the send Q-table per agent.
+    """
+    for i, agent_id in enumerate(columns["agent_id"]):
+        record = {field: columns[field][i].item() for field in STAT_FIELDS + AVERAGE_FIELDS}
+        record["agent_id"] = str(agent_id)
+        record["desirability_score"] = columns["desirability_score"][i].item()
+        with open(f"{results_dir}/{agent_id}.json", "w") as file:
+            json.dump(record, file, indent=4)
+
+        send_q_table = q_tables[f"send_q_table_{columns['gender'][i]}"][columns["index"][i]]
+        np.savetxt(f"{results_dir}/{agent_id}_q.csv", send_q_table, delimiter=",")
+
+
+def is_columnar(results_dir):
+    return any(os.path.exists(os.path.join(results_dir, f"{STATS_TABLE}{ext}")) for ext in (".parquet", ".npy"))
+
+
+def load_stats(results_dir):
+    """
+    Load the stats table of a run written in the columnar format.
+
+    :return: dict mapping column names to arrays, see results_columns
+    """
+    path = os.path.join(results_dir, STATS_TABLE)
+    if os.path.exists(f"{path}.parquet"):
+        import pyarrow.parquet as pq
+        table = pq.read_table(f"{path}.parquet")
+        columns = {name: table.column(name).to_numpy() for name in table.column_names}
+        # string columns come back as object arrays of str, store them like the .npy table does
+        return {name: column.astype(str) if column.dtype == object else column for name, column in columns.items()}
+
+    table = np.load(f"{path}.npy")
+    return {name: table[name] for name in table.dtype.names}
+
+
+def load_records(results_dir):
+    """
+    Load the stats of every agent of a run as a list of dicts, in the format of Stats.save.
+    Reads the columnar format if present and the per-agent JSON files otherwise.
+    """
+    if not is_columnar(results_dir):
+        data = []
+        for file_name in os.listdir(results_dir):
+            if file_name.endswith(".json"):
+                with open(os.path.join(results_dir, file_name), 'r') as f:
+                    data.append(json.load(f))
+        return data
+
+    columns = load_stats(results_dir)
+    keys = STAT_FIELDS + AVERAGE_FIELDS + ["agent_id", "desirability_score"]
+    # tolist gives Python values for every dtype, including the object arrays of str some readers return
+    values = {key: columns[key].tolist() for key in keys}
+    return [{key: values[key][i] for key in keys} for i in range(len(values["agent_id"]))]
+
+
+def load_q_tables(results_dir, mmap_mode="r"):
+    """
+    Load the stacked Q-tables of a run written in the columnar format.
+
+    :param mmap_mode: passed to np.load. The default memory-maps the tables instead of reading them
+    :return: dict mapping f"{table}_{gender}" to arrays of shape [agents of gender, agents of opposite gender, 2]
+    """
+    q_tables = dict()
+    for file_name in sorted(os.listdir(results_dir)):
+        name, ext = os.path.splitext(file_name)
+        if ext == ".npy" and name.startswith(Q_TABLES):
+            q_tables[name] = np.load(os.path.join(results_dir, file_name), mmap_mode=mmap_mode)
+    return q_tables
+
+
+def export_legacy(results_dir, export_dir=None):
+    """
+    Export a run written in the columnar format to the per-agent JSON + CSV layout.
+
+    :param export_dir: Directory to export to. Defaults to results_dir
+    """
+    write_results(export_dir or results_dir, load_stats(results_dir), load_q_tables(results_dir), results_format="legacy")
@@ -1,5 +1,7 @@
 import json
 
+import numpy as np
+
 
 class Stats:
     def __init__(self):
@@ -7,20 +9,29 @@ class Stats:
         self.roses_sent = 0 # roses are attached to proposals, not sent separately
         self.proposals_sent_accepted = 0
         self.roses_sent_accepted = 0
-        self.adsnr_sent = 0   # Avg. Desirability Score of agents proposed to with No Rose (ADSNR)
-        self.adsnr_sent_accepted = 0  # Avg. Desirability Score of agents who accepted proposals with No Rose (ADSNR)
-        self.adsr_sent = 0  # props sent with rose...
-        self.adsr_sent_accepted = 0 # ...you get the idea
+        self.sdsnr_sent = 0.0   # Sum of Desirability Scores of agents proposed to with No Rose (SDSNR), see averages
+        self.sdsnr_sent_accepted = 0.0  # Sum of Desirability Scores of agents who accepted proposals with No Rose
+        self.sdsr_sent = 0.0  # props sent with rose...
+        self.sdsr_sent_accepted = 0.0 # ...you get the idea
 
         self.proposals_received = 0
         self.roses_received = 0
         self.proposals_received_accepted = 0
         self.roses_received_accepted = 0
-        self.adsnr_received = 0
-        self.adsnr_received_accepted = 0
-        self.adsr_received = 0
-        self.adsr_received_accepted = 0
+        self.sdsnr_received = 0.0
+        self.sdsnr_received_accepted = 0.0
+        self.sdsr_received = 0.0
+        self.sdsr_received_accepted = 0.0
 
+    @classmethod
+    def from_columns(cls, columns, i):
+        """
+        Stats of agent i from stat columns with one entry per agent, see track.
+        """
+        stats = cls()
+        for field in STAT_FIELDS:
+            setattr(stats, field, columns[field][i].item())
+        return stats
 
     # def save(self, agent, results_dir="results"):
     #     # write stats to file
@@ -33,50 +44,95 @@ class Stats:
     #         f.write(f"Average desirability score of sent proposals: {self.avg_desirability_score_sent}\n")
     
     def save(self, agent, results_dir="results"):
-        self.agent_id = agent.id
-        self.desirability_score = agent.desirability_score
+        self.dump(agent.id, agent.desirability_score, results_dir=results_dir)
+
+    def dump(self, agent_id, desirability_score, results_dir="results"):
         # write stats to file
-        with open(f"{results_dir}/{agent.id}.json", "w") as file:
-            json.dump(self.__dict__, file, indent=4)
-    
-    @staticmethod
-    def update_avg(old_avg, n):
-        if old_avg == 0:
-            return n
-        else:
-            return (old_avg + n) / 2
-
-    def track_sent(self, proposal):
-        self.proposals_sent += 1
-
-        if proposal.has_rose:
-            self.roses_sent += 1
-            self.adsr_sent = Stats.update_avg(old_avg=self.adsr_sent, n=proposal.receiver.desirability_score)
-            if proposal.accepted:
-                self.roses_sent_accepted += 1
-                self.proposals_sent_accepted += 1
-                self.adsr_sent_accepted = Stats.update_avg(old_avg=self.adsr_sent_accepted, n=proposal.receiver.desirability_score)
-        else:
-            self.adsnr_sent = Stats.update_avg(old_avg=self.adsnr_sent, n=proposal.receiver.desirability_score)
-            if proposal.accepted:
-                self.proposals_sent_accepted += 1
-                self.adsnr_sent_accepted = Stats.update_avg(old_avg=self.adsnr_sent_accepted, n=proposal.receiver.desirability_score)
+        with open(f"{results_dir}/{agent_id}.json", "w") as file:
+            json.dump(self.to_dict(agent_id, desirability_score), file, indent=4)
+
+    def to_dict(self, agent_id, desirability_score):
+        """
+        Stats of an agent in the format they are saved in, with the average desirability scores.
+        """
+        return {**self.__dict__, **averages(self.__dict__), "agent_id": agent_id, "desirability_score": desirability_score}
+
+
+STAT_FIELDS = list(Stats().__dict__)
+
+
+# Avg. Desirability Score fields, derived from the sds* sums and the counters of the same proposals
+AVERAGE_FIELDS = [f"ads{field[3:]}" for field in STAT_FIELDS if field.startswith("sds")]
+
+
+def stat_dtype(field):
+    # counters are integers, the sds* fields are sums of desirability scores and the ads* fields their averages
+    return float if field.startswith(("sds", "ads")) else int
+
+
+def proposal_counts(stats):
+    """
+    Number of proposals each sds*/ads* field is taken over, keyed by the field without its prefix, e.g. 'r_sent'.
+    """
+    counts = dict()
+    for direction in ("sent", "received"):
+        counts[f"r_{direction}"] = stats[f"roses_{direction}"]
+        counts[f"r_{direction}_accepted"] = stats[f"roses_{direction}_accepted"]
+        counts[f"nr_{direction}"] = np.subtract(stats[f"proposals_{direction}"], stats[f"roses_{direction}"])
+        counts[f"nr_{direction}_accepted"] = np.subtract(stats[f"proposals_{direction}_accepted"], stats[f"roses_{direction}_accepted"])
+    return counts
+
+
+def averages(stats):
+    """
+    Exact average desirability scores (the ads* fields) from the sums and counters of a Stats.__dict__ or of stat columns.
+    Averages over no proposals are nan.
+    """
+    result = dict()
+    for key, count in proposal_counts(stats).items():
+        count = np.asarray(count)
+        mean = np.full(count.shape, np.nan)
+        np.divide(stats[f"sds{key}"], count, out=mean, where=count > 0)
+        result[f"ads{key}"] = mean if mean.ndim else mean.item()
+    return result
+
+
+def sums(stats):
+    """
+    The sds* sums from the ads* averages and the counters, for stats saved before the sums were. Those averages were
+    running approximations rather than exact means, so the sums are too. Sums over no proposals are 0.
+    """
+    result = dict()
+    for key, count in proposal_counts(stats).items():
+        count = np.asarray(count)
+        total = np.where(count > 0, np.asarray(stats[f"ads{key}"], dtype=float) * count, 0.0)
+        result[f"sds{key}"] = total if total.ndim else total.item()
+    return result
+
+
+def track(stats, direction, agents, desirability_score, has_rose, accepted):
+    """
+    Add a batch of proposals to stat columns, e.g. every proposal of an episode at once.
+
+    :param stats: dict mapping STAT_FIELDS to arrays with one entry per agent
+    :param direction: 'sent' to track proposals for their senders, 'received' for their receivers
+    :param agents: index of the tracking agent of each proposal. Agents may repeat
+    :param desirability_score: desirability score of the other agent of each proposal
+    :param has_rose: whether each proposal had a rose
+    :param accepted: whether each proposal was accepted
+    """
+    np.add.at(stats[f"proposals_{direction}"], agents, 1)
+    np.add.at(stats[f"proposals_{direction}_accepted"], agents[accepted], 1)
+    np.add.at(stats[f"roses_{direction}"], agents[has_rose], 1)
+    np.add.at(stats[f"roses_{direction}_accepted"], agents[has_rose & accepted], 1)
+    for key, mask in [
+        (f"sdsr_{direction}", has_rose),
+        (f"sdsr_{direction}_accepted", has_rose & accepted),
+        (f"sdsnr_{direction}", ~has_rose),
+        (f"sdsnr_{direction}_accepted", ~has_rose & accepted),
+    ]:
+        np.add.at(stats[key], agents[mask], desirability_score[mask])
 
-    
-    def track_received(self, proposal):
-        self.proposals_received += 1
-
-        if proposal.has_rose:
-            self.roses_received += 1
-            self.adsr_received = Stats.update_avg(old_avg=self.adsr_received, n=proposal.sender.desirability_score)
-            if proposal.accepted:
-                self.roses_received_accepted += 1
-                self.proposals_received_accepted += 1
-                self.adsr_received_accepted = Stats.update_avg(old_avg=self.adsr_received_accepted, n=proposal.sender.desirability_score)
-        else:
-            self.adsnr_received = Stats.update_avg(old_avg=self.adsnr_received, n=proposal.sender.desirability_score)
-            if proposal.accepted:
-                self.proposals_received_accepted += 1
-                self.adsnr_received_accepted = Stats.update_avg(old_avg=self.adsnr_received_accepted, n=proposal.sender.desirability_score)
-        
 
+def rate(numerator, denominator):
+    return numerator / denominator if denominator > 0 else float("nan")
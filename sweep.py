@@ -0,0 +1,133 @@
+import argparse
+import csv
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from environment.batch_env import BatchedEnvironment
+from environment.progress import progress_bar
+from sim import ENGINES, parse_dict
+from stats.analysis import summarize_columns
+
+
+def run(params):
+    """
+    Run one simulation of the sweep and return its summary row. Runs in a worker process.
+
+    :param params: dict with the grid values of the run, its seed and the shared simulation settings
+    """
+    env = ENGINES[params["engine"]](num_men=params["num_men"], num_women=params["num_women"], max_proposals=params["max_proposals"],
+                                    rose_distribution=params["rose_distribution"], cache_max_q=params["cache_max_q"], seed=params["seed"])
+    env.simulate(n=params["num_episodes"], save_results=True, save_ep=params["save_ep"], results_dir=params["results_dir"], progress=False)
+
+    row = {key: params[key] for key in ["run", "num_men", "num_women", "max_proposals", "rose_distribution", "seed"]}
+    row.update(summarize_columns(env.results_columns()))
+    return row
+
+
+def run_batch(batch):
+    """
+    Run every seed of one grid point together in a BatchedEnvironment and return their summary rows.
+    Runs in a worker process.
+
+    :param batch: list of run parameters that only differ in their seed, see grid
+    """
+    params = batch[0]
+    env = BatchedEnvironment([run_params["seed"] for run_params in batch], num_men=params["num_men"], num_women=params["num_women"],
+                             max_proposals=params["max_proposals"], rose_distribution=params["rose_distribution"],
+                             cache_max_q=params["cache_max_q"])
+    env.simulate(n=params["num_episodes"], save_results=True, save_ep=params["save_ep"],
+                 results_dirs=[run_params["results_dir"] for run_params in batch], progress=False)
+
+    rows = list()
+    for market, run_params in enumerate(batch):
+        row = {key: run_params[key] for key in ["run", "num_men", "num_women", "max_proposals", "rose_distribution", "seed"]}
+        row.update(summarize_columns(env.results_columns(market)))
+        rows.append(row)
+    return rows
+
+
+def batches(runs):
+    """
+    Group the runs of a sweep by grid point, so the seeds of each one can run as one BatchedEnvironment.
+    """
+    groups = dict()
+    for params in runs:
+        key = tuple(str(value) for name, value in params.items() if name not in ("run", "seed", "results_dir"))
+        groups.setdefault(key, list()).append(params)
+    return list(groups.values())
+
+
+def grid(args):
+    """
+    Expand the command line arguments into the list of runs of the sweep, one per grid point and seed.
+    """
+    runs = list()
+    for num_men, num_women, max_proposals, (d_idx, rose_distribution), seed in itertools.product(
+        args.num_men, args.num_women, args.max_proposals, enumerate(args.rose_distribution), args.seeds
+    ):
+        name = f"men{num_men}_women{num_women}_proposals{max_proposals}_roses{d_idx}_seed{seed}"
+        runs.append({
+            "run": name,
+            "num_men": num_men,
+            "num_women": num_women,
+            "max_proposals": max_proposals,
+            "rose_distribution": rose_distribution,
+            "seed": seed,
+            "engine": args.engine,
+            "cache_max_q": args.cache_max_q,
+            "num_episodes": args.num_episodes,
+            "save_ep": args.save_ep,
+            "results_dir": os.path.join(args.out_dir, name),
+        })
+    return runs
+
+
+def sweep(runs, jobs=None, summary_file=None, batch=False):
+    """
+    Run independent simulations in a process pool.
+
+    :param runs: list of run parameters, see grid
+    :param jobs: Number of worker processes. Defaults to the number of CPU cores
+    :param summary_file: CSV file to write one summary row per run to
+    :param batch: Whether to run the seeds of each grid point together in one BatchedEnvironment, see run_batch.
+                  Gives the same results as running them one by one
+    """
+    rows = list()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        if batch:
+            futures = [pool.submit(run_batch, group) for group in batches(runs)]
+        else:
+            futures = [pool.submit(run, params) for params in runs]
+        for future in progress_bar(as_completed(futures), total=len(futures)):
+            rows.extend(future.result() if batch else [future.result()])
+
+    rows.sort(key=lambda row: row["run"])
+    if summary_file:
+        with open(summary_file, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a parameter sweep of independent simulations in parallel.")
+    parser.add_argument("--num_men", type=int, nargs="+", default=[10], help="Numbers of male participants to sweep. Default is 10.")
+    parser.add_argument("--num_women", type=int, nargs="+", default=[10], help="Numbers of women participants to sweep. Default is 10.")
+    parser.add_argument("--max_proposals", type=int, nargs="+", default=[3], help="Maximum numbers of proposals to sweep. Default is 3.")
+    parser.add_argument("--rose_distribution", type=parse_dict, nargs="+", default=[{0.8: 2, 0.2: 6}], help="Rose distributions to sweep. Default is {0.8: 2, 0.2: 6}.")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0], help="Seeds to run every grid point with. Default is 0.")
+    parser.add_argument("--num_episodes", type=int, default=1000, help="Number of episodes to run. Default is 1000.")
+    parser.add_argument("--save_ep", type=int, default=800, help="Episode on which to start saving results. Default is 800.")
+    parser.add_argument("--engine", type=str, choices=list(ENGINES), default="agent", help="Simulation engine. Default is 'agent'.")
+    parser.add_argument("--cache_max_q", action="store_true", help="Raise flag to keep a running maximum of each Q-table.")
+    parser.add_argument("--batch", action="store_true", help="Raise flag to run all seeds of a grid point as one batch of markets stepped together. Much faster for many small markets. Ignores --engine.")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes. Default is the number of CPU cores.")
+    parser.add_argument("--out_dir", type=str, default="sweep", help="Directory to save every run's results and the summary to. Default is 'sweep'.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    sweep(grid(args), jobs=args.jobs, summary_file=os.path.join(args.out_dir, "summary.csv"), batch=args.batch)
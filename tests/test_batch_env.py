@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from environment.batch_env import BatchedEnvironment
+from environment.env import Environment
+from environment.vec_env import VectorizedEnvironment
+from stats.results import load_q_tables, load_stats
+
+
+SEEDS = [0, 3, 7]
+MARKET = dict(num_men=6, num_women=5, max_proposals=2)
+
+
+class TestBatchedEnvironment(unittest.TestCase):
+    def check(self, engine, **kwargs):
+        # every market of the batch matches a separate run with its seed
+        batch = BatchedEnvironment(SEEDS, **MARKET, **kwargs)
+        with tempfile.TemporaryDirectory() as results_dir:
+            results_dirs = [os.path.join(results_dir, f"market_{b}") for b in range(len(SEEDS))]
+            batch.simulate(100, save_results=True, save_ep=30, results_dirs=results_dirs, progress=False)
+            for b, seed in enumerate(SEEDS):
+                with self.subTest(engine=engine.__name__, seed=seed, **kwargs):
+                    env = engine(**MARKET, seed=seed, **kwargs)
+                    env.simulate(100, save_results=True, save_ep=30, results_dir=os.path.join(results_dir, f"separate_{b}"), progress=False)
+                    self.assertSameColumns(batch.results_columns(b), env.results_columns())
+                    self.assertSameColumns(batch.market_q_tables(b), env.q_tables())
+                    # and so do the files written for it
+                    self.assertSameColumns(load_stats(results_dirs[b]), load_stats(os.path.join(results_dir, f"separate_{b}")))
+                    self.assertSameColumns(load_q_tables(results_dirs[b]), env.q_tables())
+
+    def assertSameColumns(self, first, second):
+        self.assertEqual(set(first), set(second))
+        for name in first:
+            np.testing.assert_array_equal(first[name], second[name], err_msg=name)
+
+    def test_separate_runs(self):
+        for engine in (Environment, VectorizedEnvironment):
+            self.check(engine)
+
+    def test_options(self):
+        self.check(VectorizedEnvironment, cache_max_q=True)
+        self.check(VectorizedEnvironment, q_dtype="float32")
+
+    def test_too_many_proposals(self):
+        with self.assertRaises(ValueError):
+            BatchedEnvironment(SEEDS, num_men=3, num_women=2, max_proposals=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from environment.env import Environment
+from environment.vec_env import VectorizedEnvironment
+
+
+ENGINES = (Environment, VectorizedEnvironment)
+MARKET = dict(num_men=7, num_women=9, max_proposals=3, seed=11)
+
+
+def run(engine, n=120, save_ep=40, **kwargs):
+    env = engine(**{**MARKET, **kwargs})
+    with tempfile.TemporaryDirectory() as results_dir:
+        env.simulate(n, save_results=True, save_ep=save_ep, results_dir=results_dir, progress=False)
+    return env
+
+
+class EngineTestCase(unittest.TestCase):
+    def assertSameRun(self, first, second):
+        # same Q-tables and stats, whatever engine or storage produced them
+        first_q, second_q = first.q_tables(), second.q_tables()
+        self.assertEqual(set(first_q), set(second_q))
+        for name in first_q:
+            np.testing.assert_array_equal(first_q[name], second_q[name], err_msg=name)
+        first_columns, second_columns = first.results_columns(), second.results_columns()
+        self.assertEqual(set(first_columns), set(second_columns))
+        for name in first_columns:
+            np.testing.assert_array_equal(first_columns[name], second_columns[name], err_msg=name)
+
+
+class TestEngines(EngineTestCase):
+    def test_vectorized_matches_agent(self):
+        self.assertSameRun(run(Environment), run(VectorizedEnvironment))
+
+    def test_options_match_agent(self):
+        for options in ({"cache_max_q": True}, {"q_dtype": "float32"}, {"q_dtype": "float32", "cache_max_q": True}):
+            with self.subTest(**options):
+                self.assertSameRun(run(Environment, **options), run(VectorizedEnvironment, **options))
+
+    def test_cache_max_q(self):
+        for engine in ENGINES:
+            with self.subTest(engine=engine.__name__):
+                self.assertSameRun(run(engine), run(engine, cache_max_q=True))
+
+    def test_float32(self):
+        env = run(Environment, q_dtype="float32")
+        self.assertTrue(all(q_table.dtype == np.float32 for q_table in env.q_tables().values()))
+
+    def test_sparse_matches_dense(self):
+        for cache_max_q in (False, True):
+            with self.subTest(cache_max_q=cache_max_q):
+                self.assertSameRun(run(Environment, cache_max_q=cache_max_q), run(Environment, cache_max_q=cache_max_q, sparse_q=True))
+
+    def test_memmap_matches_memory(self):
+        for engine in ENGINES:
+            with self.subTest(engine=engine.__name__), tempfile.TemporaryDirectory() as q_dir:
+                q_path = os.path.join(q_dir, "q_tables.dat")
+                self.assertSameRun(run(engine), run(engine, q_path=q_path))
+                self.assertTrue(os.path.exists(q_path))
+
+    def test_sparse_memmap(self):
+        with self.assertRaises(ValueError):
+            Environment(**MARKET, sparse_q=True, q_path="q_tables.dat")
+
+    def test_too_many_proposals(self):
+        for engine in ENGINES:
+            with self.subTest(engine=engine.__name__), self.assertRaises(ValueError):
+                engine(num_men=3, num_women=2, max_proposals=3)
+
+
+class TestCheckpoints(EngineTestCase):
+    def resume(self, first, second, **kwargs):
+        # run first, stop after a checkpoint and finish the run with second
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint_path = os.path.join(checkpoint_dir, "checkpoint.npz")
+            interrupted = first(**{**MARKET, **kwargs})
+            interrupted.simulate(90, save_results=True, save_ep=40, results_dir=os.path.join(checkpoint_dir, "interrupted"), progress=False,
+                                 checkpoint_every=30, checkpoint_path=checkpoint_path)
+            resumed = second(**{**MARKET, **kwargs})
+            start_episode = resumed.load_checkpoint(checkpoint_path)
+            self.assertEqual(start_episode, 90)
+            with tempfile.TemporaryDirectory() as results_dir:
+                resumed.simulate(120, save_results=True, save_ep=40, results_dir=results_dir, progress=False, start_episode=start_episode)
+        return resumed
+
+    def test_resume(self):
+        for first in ENGINES:
+            for second in ENGINES:
+                with self.subTest(first=first.__name__, second=second.__name__):
+                    self.assertSameRun(run(first), self.resume(first, second))
+
+    def test_resume_options(self):
+        for options in ({"cache_max_q": True, "q_dtype": "float32"}, {"sparse_q": True}):
+            with self.subTest(**options):
+                self.assertSameRun(run(Environment, **options), self.resume(Environment, Environment, **options))
+
+    def test_other_market(self):
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint_path = os.path.join(checkpoint_dir, "checkpoint.npz")
+            run(Environment).save_checkpoint(checkpoint_path, 120)
+            for engine in ENGINES:
+                with self.subTest(engine=engine.__name__), self.assertRaises(ValueError):
+                    engine(**{**MARKET, "num_women": 8}).load_checkpoint(checkpoint_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from stats.results import load_records, load_stats, results_columns, write_results
+from stats.stats import AVERAGE_FIELDS, STAT_FIELDS, stat_dtype
+
+
+def columns():
+    # two men and one woman with distinct stats
+    sides = list()
+    for gender, desirability in (("man", [40.5, 61.25]), ("woman", [55.0])):
+        stats = {field: (np.arange(len(desirability)) + 3).astype(stat_dtype(field)) for field in STAT_FIELDS}
+        sides.append((gender, desirability, stats))
+    return results_columns(sides)
+
+
+class TestLoadRecords(unittest.TestCase):
+    def check(self, results_dir, table):
+        write_results(results_dir, columns(), {})
+        records = load_records(results_dir)
+        self.assertEqual([record["agent_id"] for record in records], ["man_0", "man_1", "woman_0"])
+        self.assertEqual([record["desirability_score"] for record in records], [40.5, 61.25, 55.0])
+        for record in records:
+            self.assertEqual(set(record), set(STAT_FIELDS + AVERAGE_FIELDS + ["agent_id", "desirability_score"]))
+            self.assertIsInstance(record["agent_id"], str)
+            self.assertIsInstance(record["proposals_sent"], int)
+            self.assertIsInstance(record["sdsr_sent"], float)
+        self.assertEqual(load_stats(results_dir)["gender"].tolist(), ["man", "man", "woman"])
+        self.assertTrue(os.path.exists(os.path.join(results_dir, table)))
+
+    def test_npy(self):
+        # without pyarrow, the stats table is written as a structured .npy
+        with tempfile.TemporaryDirectory() as results_dir, mock.patch.dict(sys.modules, {"pyarrow": None, "pyarrow.parquet": None}):
+            self.check(results_dir, "stats.npy")
+
+    def test_parquet(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+        with tempfile.TemporaryDirectory() as results_dir:
+            self.check(results_dir, "stats.parquet")
+
+
+if __name__ == "__main__":
+    unittest.main()
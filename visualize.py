@@ -1,193 +1,249 @@
 import argparse
 import os
-import json
 import math
-import matplotlib.pyplot as plt
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
+from stats.metrics import metrics_columns, read_metrics
+from stats.analysis import as_columns, group_by, load_columns, rates, rose_counts, round_rates
+
 RESULTS_DIR = "results"
 
+def figure(**kwargs):
+    # matplotlib takes most of this module's import time, so it is only loaded by the functions that plot.
+    # The analyze_* functions and load_data work without it.
+    # Figures are drawn through their own Agg canvas instead of pyplot's global state, so any number of them
+    # can be rendered side by side in worker processes, without a display
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
 def load_data(results_dir):
-    data = []
-    for file_name in os.listdir(results_dir):
-        if file_name.endswith(".json"):
-            with open(os.path.join(results_dir, file_name), 'r') as f:
-                data.append(json.load(f))
-    return data
+    # every agent's stats as one array per field: the columnar stats table if the run has one,
+    # and the per-agent JSON files, read in parallel, otherwise
+    return load_columns(results_dir)
 
 def analyze_rose_effect(data):
-    proposals_with_rose = []
-    proposals_without_rose = []
-
-    for agent in data:
-        roses_sent = agent['roses_sent']
-        proposals_sent = agent['proposals_sent']
-        roses_accepted = agent['roses_sent_accepted']
-        proposals_accepted = agent['proposals_sent_accepted']
+    data = as_columns(data)
+    proposals = rose_counts(data, "sent")
 
-        if roses_sent > 0:
-            proposals_with_rose.append(roses_accepted / roses_sent)
-        if proposals_sent - roses_sent > 0:
-            proposals_without_rose.append((proposals_accepted - roses_accepted) / (proposals_sent - roses_sent))
+    # acceptance rate of every agent's proposals with and without a rose, for agents who sent any
+    proposals_with_rose, proposals_without_rose = (
+        rates(accepted, sent)[sent > 0] for sent, accepted in (proposals[True], proposals[False])
+    )
 
     return proposals_with_rose, proposals_without_rose
 
 def analyze_desirability_effect(data):
-    desirability = []
-    acceptance_rate_sent = []
-    acceptance_rate_received = []
-
-    for agent in data:
-        total_proposals_sent = agent['proposals_sent']
-        total_proposals_accepted = agent['proposals_sent_accepted']
-
-        total_proposals_received = agent['proposals_received']
-        total_proposals_received_accepted = agent['proposals_received_accepted']
-
-        desirability.append(agent['desirability_score'])
+    data = as_columns(data)
+    # only agents with both rates, e.g. groups of a Market that never propose, or are never proposed to, are left out
+    both = (data['proposals_sent'] > 0) & (data['proposals_received'] > 0)
+    desirability = data['desirability_score'][both]
 
-        if total_proposals_sent > 0:
-            acceptance_rate_sent.append(total_proposals_accepted / total_proposals_sent)
-
-        if total_proposals_received > 0:
-            acceptance_rate_received.append(total_proposals_received_accepted / total_proposals_received)
-    
-    if len(desirability) != len(acceptance_rate_sent) or len(desirability) != len(acceptance_rate_received):
-        raise ValueError("Data mismatch. Please check the data for consistency.")
+    acceptance_rate_sent = rates(data['proposals_sent_accepted'], data['proposals_sent'])[both]
+    acceptance_rate_received = rates(data['proposals_received_accepted'], data['proposals_received'])[both]
 
     return desirability, acceptance_rate_sent, acceptance_rate_received
 
 def visualize_rose_effect(data, save_to="visualizations"):
+    fig = figure()
+    ax = fig.add_subplot()
     proposals_with_rose, proposals_without_rose = analyze_rose_effect(data)
 
     labels = ['With Rose', 'Without Rose']
     means = [
-        np.mean(proposals_with_rose) if proposals_with_rose else 0,
-        np.mean(proposals_without_rose) if proposals_without_rose else 0
+        np.mean(proposals_with_rose) if len(proposals_with_rose) else 0,
+        np.mean(proposals_without_rose) if len(proposals_without_rose) else 0
     ]
     
     rose_color = "#d10026"
     green_color = "#00752d"
-    plt.bar(labels, means, color=[rose_color, green_color])
-    plt.ylabel('Acceptance Rate')
-    plt.title('Effect of Sending Roses on Acceptance Rates')
+    ax.bar(labels, means, color=[rose_color, green_color])
+    ax.set_ylabel('Acceptance Rate')
+    ax.set_title('Effect of Sending Roses on Acceptance Rates')
     
     for i, mean in enumerate(means):
-        plt.text(i, mean + 0.01, f"{mean:.2f}", ha='center', va='bottom')
+        ax.text(i, mean + 0.01, f"{mean:.2f}", ha='center', va='bottom')
 
     max_mean = max(means)
-    plt.ylim(0, max_mean + 0.1 * max_mean)
-    plt.savefig(f"{save_to}/rose_effect.png")
-    plt.close()
+    ax.set_ylim(0, max_mean + 0.1 * max_mean)
+    fig.savefig(f"{save_to}/rose_effect.png")
 
 def visualize_desirability_effect(data, save_to="visualizations"):
+    fig = figure()
+    ax = fig.add_subplot()
     desirability, acceptance_rate_sent, acceptance_rate_received = analyze_desirability_effect(data)
 
-    plt.scatter(desirability, acceptance_rate_sent, alpha=0.5, label="Sent")
-    plt.scatter(desirability, acceptance_rate_received, alpha=0.5, label="Received")
-    plt.xlabel('Agent Desirability Score')
-    plt.ylabel('Acceptance Rate')
-    plt.title('Effect of Desirability on Proposal Outcomes')
-    plt.legend()
-    plt.savefig(f"{save_to}/desirability_effect.png")
-    plt.close()
+    ax.scatter(desirability, acceptance_rate_sent, alpha=0.5, label="Sent")
+    ax.scatter(desirability, acceptance_rate_received, alpha=0.5, label="Received")
+    ax.set_xlabel('Agent Desirability Score')
+    ax.set_ylabel('Acceptance Rate')
+    ax.set_title('Effect of Desirability on Proposal Outcomes')
+    ax.legend()
+    fig.savefig(f"{save_to}/desirability_effect.png")
 
 
 def analyze_gender_rose_usage(data):
-    men_usage = []
-    women_usage = []
-    
-    for agent in data:
-        if agent['proposals_sent'] > 0:
-            rose_usage = agent['roses_sent'] / agent['proposals_sent']
-            if agent['agent_id'].startswith('man'):
-                men_usage.append(rose_usage)
-            elif agent['agent_id'].startswith('woman'):
-                women_usage.append(rose_usage)
-    
-    return men_usage, women_usage
+    data = as_columns(data)
+    rose_usage = rates(data['roses_sent'], data['proposals_sent'])
+    usage = group_by(data, rose_usage, by='gender', mask=data['proposals_sent'] > 0, groups=['man', 'woman'])
+
+    return usage['man'], usage['woman']
 
 def visualize_gender_rose_usage(data, save_to="visualizations"):
     men_usage, women_usage = analyze_gender_rose_usage(data)
     
-    plt.figure(figsize=(10, 6))
-    plt.boxplot([men_usage, women_usage], labels=['Men', 'Women'])
-    plt.title('Rose Usage Rate by Gender')
-    plt.ylabel('Proportion of Proposals with Roses')
-    plt.savefig(f"{save_to}/gender_rose_usage.png")
-    plt.close()
+    fig = figure(figsize=(10, 6))
+    ax = fig.add_subplot()
+    ax.boxplot([men_usage, women_usage], labels=['Men', 'Women'])
+    ax.set_title('Rose Usage Rate by Gender')
+    ax.set_ylabel('Proportion of Proposals with Roses')
+    fig.savefig(f"{save_to}/gender_rose_usage.png")
 
 def analyze_gender_acceptance_rates(data, type="sent"):
     if type not in ["sent", "received"]:
         raise ValueError("Invalid type. Please specify 'sent' or 'received'.")
-    
-    men_rates = []
-    women_rates = []
-    
-    for agent in data:
-        if type == "received":
-            acceptance_rate = round(agent['proposals_received_accepted'] / agent['proposals_received'], 1)
-            if agent['agent_id'].startswith('man'):
-                men_rates.append(acceptance_rate)
-            elif agent['agent_id'].startswith('woman'):
-                women_rates.append(acceptance_rate)
-        elif type == "sent":
-            acceptance_rate = round(agent['proposals_sent_accepted'] / agent['proposals_sent'], 1)
-            if agent['agent_id'].startswith('man'):
-                men_rates.append(acceptance_rate)
-            elif agent['agent_id'].startswith('woman'):
-                women_rates.append(acceptance_rate)
-    
-    return men_rates, women_rates
+
+    data = as_columns(data)
+    proposals = data[f'proposals_{type}']
+    acceptance_rate = round_rates(rates(data[f'proposals_{type}_accepted'], proposals), 1)
+    # agents without proposals have no rate
+    acceptance_rates = group_by(data, acceptance_rate, by='gender', mask=proposals > 0, groups=['man', 'woman'])
+
+    return acceptance_rates['man'], acceptance_rates['woman']
 
 def visualize_gender_sent_acceptance_rates(data, save_to="visualizations"):
     men_rates, women_rates = analyze_gender_acceptance_rates(data, type="sent")
     
-    plt.figure(figsize=(7, 5))
-    plt.boxplot([men_rates, women_rates], labels=['Men', 'Women'])
-    plt.title('Proposal Sent Acceptance Rates by Gender')
-    plt.ylabel('Acceptance Rate')
-    plt.savefig(f"{save_to}/gender_sent_acceptance_rates.png")
-    plt.close()
+    fig = figure(figsize=(7, 5))
+    ax = fig.add_subplot()
+    ax.boxplot([men_rates, women_rates], labels=['Men', 'Women'])
+    ax.set_title('Proposal Sent Acceptance Rates by Gender')
+    ax.set_ylabel('Acceptance Rate')
+    fig.savefig(f"{save_to}/gender_sent_acceptance_rates.png")
 
 def visualize_gender_received_acceptance_rates(data, save_to="visualizations"):
     men_rates, women_rates = analyze_gender_acceptance_rates(data, type="received")
     
-    plt.figure(figsize=(7, 5))
-    plt.boxplot([men_rates, women_rates], labels=['Men', 'Women'])
-    plt.title('Proposal Received Acceptance Rates by Gender')
-    plt.ylabel('Acceptance Rate')
-    plt.savefig(f"{save_to}/gender_received_acceptance_rates.png")
-    plt.close()
-
-def go(results_dir="results", save_to="visualizations"):
+    fig = figure(figsize=(7, 5))
+    ax = fig.add_subplot()
+    ax.boxplot([men_rates, women_rates], labels=['Men', 'Women'])
+    ax.set_title('Proposal Received Acceptance Rates by Gender')
+    ax.set_ylabel('Acceptance Rate')
+    fig.savefig(f"{save_to}/gender_received_acceptance_rates.png")
+
+def visualize_convergence(metrics, save_to="visualizations"):
+    episodes = metrics["episode"]
+
+    fig = figure(figsize=(10, 9))
+    ax = fig.add_subplot(3, 1, 1)
+    ax.plot(episodes, metrics["acceptance_rate"], label="All", color="black")
+    ax.plot(episodes, metrics["rose_acceptance_rate"], label="With Rose", color="#d10026", alpha=0.6)
+    ax.plot(episodes, metrics["no_rose_acceptance_rate"], label="Without Rose", color="#00752d", alpha=0.6)
+    ax.set_ylabel('Acceptance Rate')
+    ax.set_title('Convergence')
+    ax.legend()
+
+    ax = fig.add_subplot(3, 1, 2)
+    ax.plot(episodes, metrics["rose_usage"], label="Rose Usage")
+    ax.plot(episodes, metrics["exploration_rate"], label="Exploration Rate")
+    ax.set_ylabel('Rate')
+    ax.legend()
+
+    ax = fig.add_subplot(3, 1, 3)
+    ax.plot(episodes, metrics["mean_send_q"], label="Send")
+    ax.plot(episodes, metrics["mean_receive_q"], label="Receive")
+    ax.set_xlabel('Episode')
+    ax.set_ylabel('Mean Q-value')
+    ax.legend()
+
+    fig.savefig(f"{save_to}/convergence.png")
+
+def follow_metrics(metrics_path, save_to="visualizations", interval=5.0):
+    # tail the metrics file of a running simulation, redrawing the convergence plot whenever episodes are added
+    records = []
+    offset = 0
+    while True:
+        if os.path.exists(metrics_path):
+            new_records, offset = read_metrics(metrics_path, offset)
+            if new_records:
+                records.extend(new_records)
+                visualize_convergence(metrics_columns(records), save_to=save_to)
+                print(f"Plotted {len(records)} episodes")
+        time.sleep(interval)
+
+def render(visualization, data, save_to):
+    # one figure, in a worker process
+    visualization(data, save_to=save_to)
+
+def go(results_dir="results", save_to="visualizations", jobs=1):
     # Load data
     data = load_data(results_dir)
 
-    visualize_rose_effect(data, save_to=save_to)
+    if not os.path.exists(save_to):
+        os.makedirs(save_to)
 
-    visualize_desirability_effect(data, save_to=save_to)
-    
-    # New 
-    visualize_gender_rose_usage(data, save_to=save_to)
-    visualize_gender_sent_acceptance_rates(data, save_to=save_to)
-    visualize_gender_received_acceptance_rates(data, save_to=save_to)
+    visualizations = [
+        visualize_rose_effect,
+        visualize_desirability_effect,
+        # New
+        visualize_gender_rose_usage,
+        visualize_gender_sent_acceptance_rates,
+        visualize_gender_received_acceptance_rates,
+    ]
+
+    if jobs == 1:
+        for visualization in visualizations:
+            visualization(data, save_to=save_to)
+    else:
+        # each figure has its own canvas, so they render independently
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(render, visualizations, [data] * len(visualizations), [save_to] * len(visualizations)))
 
+def go_many(results_dirs, save_to="visualizations", jobs=1):
+    # one figure set per run, in save_to/<path of the run relative to the runs' common parent>
+    results_dirs = [os.path.abspath(results_dir) for results_dir in results_dirs]
+    parent = os.path.commonpath(results_dirs) if len(results_dirs) > 1 else os.path.dirname(results_dirs[0])
+    save_tos = [os.path.join(save_to, os.path.relpath(results_dir, parent)) for results_dir in results_dirs]
+
+    if jobs == 1:
+        for results_dir, run_save_to in zip(results_dirs, save_tos):
+            go(results_dir=results_dir, save_to=run_save_to)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(go, results_dirs, save_tos))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Create visualizations.")
-    parser.add_argument("--results_dir", type=str, default="results", help="Directory containing results to parse")
+    parser.add_argument("--results_dir", type=str, nargs="+", default=["results"], help="Directory containing results to parse. With several, each one's figures go to a subdirectory of --save_to")
     parser.add_argument("--save_to", type=str, default="visualizations", help="Directory to save visualizations")
+    parser.add_argument("--metrics", type=str, default=None, help="Metrics file written with sim.py --metrics. Plots convergence instead of the results")
+    parser.add_argument("--follow", action="store_true", help="Keep tailing --metrics and redraw as a running simulation appends to it")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between redraws with --follow")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes rendering figures, or figure sets with several --results_dir. Default is 1, which renders them one after another")
 
     args = parser.parse_args()
 
-    # check if results directory exists
-    if not os.path.exists(args.results_dir):
-        raise FileNotFoundError(f"Directory {args.results_dir} not found.")
-
     # create visualizations folder if it doesn't exist
     if not os.path.exists(args.save_to):
         os.makedirs(args.save_to)
 
-    go(results_dir=args.results_dir, save_to=args.save_to)
+    if args.metrics:
+        if args.follow:
+            follow_metrics(args.metrics, save_to=args.save_to, interval=args.interval)
+        else:
+            visualize_convergence(metrics_columns(read_metrics(args.metrics)[0]), save_to=args.save_to)
+    else:
+        # check if results directories exist
+        for results_dir in args.results_dir:
+            if not os.path.exists(results_dir):
+                raise FileNotFoundError(f"Directory {results_dir} not found.")
+
+        if len(args.results_dir) == 1:
+            go(results_dir=args.results_dir[0], save_to=args.save_to, jobs=args.jobs)
+        else:
+            go_many(args.results_dir, save_to=args.save_to, jobs=args.jobs)